@@ -0,0 +1,106 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+"""
+per chunk compression of tensor store arrays. zstd and lz4 are optional, zlib is
+always there. All three release the GIL while (de)compressing, so chunks are
+processed in parallel by a thread pool.
+"""
+
+default_level = {"zstd": 3, "lz4": 0, "zlib": 6}
+
+
+def available_codecs():
+    codecs = []
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4 is not None:
+        codecs.append("lz4")
+    return codecs + ["zlib"]
+
+
+def default_codec():
+    return available_codecs()[0]
+
+
+def compress(data, codec, level=None):
+    level = default_level[codec] if level is None else level
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == "lz4":
+        return lz4.frame.compress(data, compression_level=level)
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def compress_rows(values, codec, level=None, chunk_rows=4096, workers=None):
+    # (number of rows, compressed bytes) of every chunk_rows rows of values
+    chunks = [values[i : i + chunk_rows] for i in range(0, len(values), chunk_rows)]
+    with ThreadPoolExecutor(workers) as executor:
+        data = executor.map(
+            lambda chunk: compress(np.ascontiguousarray(chunk).tobytes(), codec, level),
+            chunks,
+        )
+        return [(len(chunk), blob) for chunk, blob in zip(chunks, data)]
+
+
+def read_compressed_rows(file_name, spec, start=0, stop=None, workers=None):
+    """
+    rows start:stop of a compressed array, decompressing only the chunks they
+    overlap. spec["chunks"] lists [first row, rows, byte offset, byte size].
+    """
+    shape = spec["shape"]
+    dtype = np.dtype(spec["dtype"])
+    stop = shape[0] if stop is None else min(stop, shape[0])
+    if stop <= start:
+        return np.empty([0] + shape[1:], dtype=dtype)
+
+    chunks = spec["chunks"]
+    first_rows = [chunk[0] for chunk in chunks]
+    first = int(np.searchsorted(first_rows, start, side="right")) - 1
+    last = int(np.searchsorted(first_rows, stop, side="left"))
+    chunks = chunks[first:last]
+
+    base = chunks[0][2]
+    with open(file_name, "rb") as file:
+        file.seek(base)
+        data = file.read(chunks[-1][2] + chunks[-1][3] - base)
+
+    offset = chunks[0][0]
+    rows = np.empty([sum(chunk[1] for chunk in chunks)] + shape[1:], dtype=dtype)
+
+    data = memoryview(data)
+
+    def decode(chunk):
+        first_row, n_rows, byte_offset, size = chunk
+        blob = data[byte_offset - base : byte_offset - base + size]
+        blob = decompress(blob, spec["codec"])
+        target = rows[first_row - offset : first_row - offset + n_rows]
+        target[...] = np.frombuffer(blob, dtype=dtype).reshape(target.shape)
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(decode, chunks))
+
+    return rows[start - offset : stop - offset]
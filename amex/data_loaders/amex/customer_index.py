@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+from .tensor_store import is_sharded_store, load_shards, open_array
+
+"""
+customer_IDs as keys: the 64 hexadecimal characters are decoded once to their
+32 bytes (a fixed width S32 array, compared and sorted by numpy without Python
+objects; two uint64 would only keep half of the ID). Tensor stores are written
+in customer_ID order, so the customer_ID array of a store is a persisted sorted
+index: the row of a customer is found by binary search, without a pandas join.
+"""
+
+key_dtype = "S32"
+
+
+def encode_ids(cids):
+    # hexadecimal customer_IDs (str, bytes or S64) -> S32 keys
+    cids = np.asarray(cids)
+    if cids.dtype == np.dtype(key_dtype):
+        return cids
+    hex_ids = "".join(cids.astype(str).tolist())
+    return np.frombuffer(bytes.fromhex(hex_ids), dtype=key_dtype)
+
+
+def decode_ids(keys):
+    # S32 keys -> the customer_ID strings, e.g. for the submission csv
+    keys = np.asarray(keys)
+    if keys.dtype != np.dtype(key_dtype):
+        # stores written before the keys hold the S64 strings
+        return keys.astype(str)
+    hex_ids = np.ascontiguousarray(keys).tobytes().hex().encode()
+    return np.frombuffer(hex_ids, dtype="S64").astype(str)
+
+
+class CustomerIndex:
+    def __init__(self, keys, rows=None):
+        """
+        keys: S32 customer keys, rows: the row of every key (by default its
+        position). Sorted keys, the case of a tensor store, are used as is.
+        """
+        keys = encode_ids(keys)
+        rows = np.arange(len(keys)) if rows is None else np.asarray(rows)
+        if (keys[1:] < keys[:-1]).any():
+            order = np.argsort(keys, kind="stable")
+            keys, rows = keys[order], rows[order]
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, cids, missing=-1):
+        # the rows of cids (strings or keys), missing for unknown customers
+        keys = encode_ids(cids)
+        if len(self.keys) == 0:
+            return np.full(len(keys), missing)
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        return np.where(found, self.rows[positions], missing)
+
+    def customer_ids(self):
+        return decode_ids(self.keys)
+
+    @classmethod
+    def from_store(cls, store):
+        # rows count across the shards, as in ShardedDataset and submit
+        if not is_sharded_store(store):
+            return cls(open_array(store, "customer_ID"))
+        keys = [open_array(path, "customer_ID") for path, _, _ in load_shards(store)]
+        return cls(np.concatenate([encode_ids(k) for k in keys]))
+
+
+def load_labels(labels_file):
+    # the labels csv as a key index and the target of every row
+    labels = pd.read_csv(labels_file)
+    return CustomerIndex(labels["customer_ID"].to_numpy()), labels["target"].to_numpy()
+
+
+def join_labels(labels, keys):
+    # the targets of keys, every customer needs a label
+    index, target = labels
+    rows = index.lookup(keys)
+    if (rows < 0).any():
+        raise ValueError(f"{int((rows < 0).sum())} customers without a label")
+    return target[rows]
@@ -1,45 +1,33 @@
 import pytorch_lightning as pl
 import torch
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader, TensorDataset, Dataset, WeightedRandomSampler
+from torch.utils.data import (
+    DataLoader,
+    TensorDataset,
+)
 
-import pandas as pd
-import numpy as np
 import os
-import ipdb
-import torch as t
+import json
+import hashlib
+
+from .datasets import BalancedBatchSampler, BatchIndexSampler, RaggedDataset
+from .priority import PrioritizedBatchSampler, SampledDataset
+from .shared_memory import SharedTensorDataset, SharedTensors
+from .splits import load_split
+from .stats import FeatureStats, load_stats, normalizer, save_stats
+from .streaming import EpochDataLoader, ShardedDataset
+from .tensor_store import (
+    expand_x,
+    is_sharded_store,
+    is_tensor_store,
+    load_header,
+    load_shards,
+    load_tensor_store,
+    read_customers,
+    x_arrays,
+)
 
 
 class CustomDataModule(pl.LightningDataModule):
-    def load_train_df(self, train_file, train_labels):
-        # ipdb.set_trace()
-        train = pd.read_parquet(train_file, engine="fastparquet")
-        train["S_2"] = pd.to_datetime(train["S_2"])
-        tmp = train[["customer_ID", "S_2"]].groupby("customer_ID").count()
-
-        missing_cids = []
-        for nb_available_rows in range(1, 14):
-            cids = tmp[tmp["S_2"] == nb_available_rows].index.values
-            batch_missing_cids = [
-                cid for cid in cids for _ in range(13 - nb_available_rows)
-            ]
-            missing_cids.extend(batch_missing_cids)
-
-        train_part2 = train.iloc[: len(missing_cids)].copy()
-        train_part2.loc[:] = np.nan
-        train_part2["customer_ID"] = missing_cids
-
-        train = pd.concat([train_part2, train])
-
-        train = train.sort_values("customer_ID")
-
-        train_labels = pd.read_csv(train_labels)
-        train = pd.merge(train, train_labels, how="inner", on="customer_ID")
-
-        train = train.sort_values("customer_ID")
-        return train
-
     def __init__(self, params):
         super().__init__()
         self.params = params
@@ -47,13 +35,36 @@ class CustomDataModule(pl.LightningDataModule):
         self.train_batch_size = params.train_batch_size
         self.test_batch_size = params.test_batch_size
 
-        self.randomize_split = False
+        # class-balanced training batches, pos_ratio positives per batch
+        self.balanced_sampling = False
+        if params.contains("balanced_sampling"):
+            self.balanced_sampling = params.balanced_sampling
+        self.pos_ratio = params.pos_ratio if params.contains("pos_ratio") else 0.5
+        # batches per epoch, by default one pass over the training split
+        self.epoch_length = None
+        if params.contains("epoch_length"):
+            self.epoch_length = params.epoch_length
+        # loss-prioritized training batches, priorities updated by the model
+        self.prioritized_sampling = False
+        if params.contains("prioritized_sampling"):
+            self.prioritized_sampling = params.prioritized_sampling
+        self.priority_sampler = None
+        self.priority_alpha = 0.6
+        if params.contains("priority_alpha"):
+            self.priority_alpha = params.priority_alpha
+        self.priority_beta = 0.4
+        if params.contains("priority_beta"):
+            self.priority_beta = params.priority_beta
+        self.split_seed = params.split_seed if params.contains("split_seed") else 1
+        # samples shuffled together when streaming from a sharded store
+        self.shuffle_buffer = 65536
+        if params.contains("shuffle_buffer"):
+            self.shuffle_buffer = params.shuffle_buffer
+        self.streaming = False
         # num workers = number of cpus to use
         # get number of cpu's on this device
         num_workers = os.cpu_count()
         self.num_workers = num_workers
-        # self.sc = StandardScaler()
-        # self._prepare_data()
         self.prepare_tensor_data()
         return
         print("Loading data...")
@@ -64,198 +75,254 @@ class CustomDataModule(pl.LightningDataModule):
         print("Data loaded.")
 
     def load_torch_tensor(self):
+        # returns the arrays holding x (see tensor_store.layout_arrays) and y
+        store = os.path.join(self.data_location, "tensor_store")
+        if is_tensor_store(store):
+            # memory mapped, nothing is read until a sample is used
+            self.store = store
+            self.header = load_header(store)
+            tensors = load_tensor_store(store, x_arrays(self.header) + ["y"])
+            return tensors[:-1], tensors[-1]
+
+        self.store = None
+        self.header = {"layout": "dense"}
         tensor_dict = torch.load(os.path.join(self.data_location, "tensor.pt"))
-        return tensor_dict["x"], tensor_dict["y"]
+        return [tensor_dict["x"]], tensor_dict["y"]
+
+    def x_parts(self, x_tensors):
+        # the x arrays of the store, or of every shard of a sharded store
+        if not self.streaming:
+            return [x_tensors]
+        names = x_arrays(self.header)
+        return [load_tensor_store(path, names) for path, _, _ in self.shards]
+
+    def feature_stats(self, x_tensors, chunk_size=65536):
+        # NaN-aware statistics of every feature, saved in the store once
+        parts = self.x_parts(x_tensors)
+        # the last x array has a row per customer
+        n_customers = sum(part[-1].shape[0] for part in parts)
+        if self.store is not None:
+            stats = load_stats(self.store, n_customers)
+            if stats is not None:
+                return stats
+
+        # one chunked pass, expanding compact stores one chunk at a time
+        stats = None
+        for part in parts:
+            for start in range(0, part[-1].shape[0], chunk_size):
+                stop = min(start + chunk_size, part[-1].shape[0])
+                chunk = read_customers(self.header, part, start, stop)
+                x = expand_x(self.header, chunk).numpy()
+                stats = stats or FeatureStats(x.shape[-1])
+                stats.update(x)
+
+        if self.store is not None:
+            save_stats(self.store, stats, n_customers)
+        return stats
+
+    def normalize_tensors(self, x_tensors, in_place=True):
+        if self.normalization not in ("tanh", "sigmoid", "standard"):
+            return
+
+        stats = self.feature_stats(x_tensors)
+        n_categorical = self.header.get("n_categorical", 11)
+        normalize = normalizer(stats, self.normalization, n_categorical)
+        if in_place:
+            # over the x or ragged statements private to this process or shared
+            normalize(x_tensors[0])
+        else:
+            # compact batches, and memory mapped stores (an in place write would
+            # copy them page by page), are normalized per batch on device
+            self.normalize = normalize
+
+    def share_tensors(self, tensors, prepare=None):
+        # one copy per machine in /dev/shm, attached by the DataLoader workers
+        # and by the other training runs using the same data
+        store = os.path.realpath(os.path.join(self.data_location, "tensor_store"))
+        version = [store, self.header, self.normalization]
+        key = hashlib.sha1(json.dumps(version).encode()).hexdigest()[:16]
+
+        names = x_arrays(self.header) + ["y"]
+        self.shared = SharedTensors(key, dict(zip(names, tensors)), prepare)
+        return [self.shared.tensors[name] for name in names]
+
+    def resident_tensors(self, tensors):
+        # the whole data on the training device: batches are gathered there by
+        # the main process, no workers and no host to device copies
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if device == "cuda":
+            size = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+            free, _ = torch.cuda.mem_get_info()
+            # leaves most of the memory to the model and its activations
+            if size > free / 2:
+                print("Data does not fit on the device:", size / 1024**3, "GB")
+                return tensors
+            tensors = [tensor.to(device) for tensor in tensors]
+
+        self.device_resident = True
+        self.num_workers = 0
+        print("Data resident on", device)
+        return tensors
+
+    def prepare_sharded_data(self, store):
+        # out of core: batches are streamed shard by shard by ShardedDataset
+        if self.balanced_sampling or self.prioritized_sampling:
+            raise ValueError("sharded stores are read in shuffled shard order only")
+        self.streaming = True
+        self.store = store
+        self.shards = load_shards(store)
+        self.header = load_header(self.shards[0][0])
+        y = torch.cat([load_tensor_store(path, ["y"])[0] for path, _, _ in self.shards])
+        return None, y
 
     def prepare_tensor_data(self):
-        tensors = self.load_torch_tensor()
+        store = os.path.join(self.data_location, "tensor_store")
+        if is_sharded_store(store):
+            x_tensors, y = self.prepare_sharded_data(store)
+        else:
+            x_tensors, y = self.load_torch_tensor()
+        layout = self.header.get("layout", "dense")
+        self.compact = layout == "compact"
+        self.ragged = layout == "ragged"
+        # ragged batches are padded to 13 statements unless a model takes
+        # (statements, lengths, y) batches
+        self.pad_statements = True
+        if self.params.contains("pad_statements"):
+            self.pad_statements = self.params.pad_statements
+        self.normalize = None
 
         # ipdb.set_trace()
-        x = tensors[0]
 
+        self.normalization = "none"
         if self.params.contains("normalization"):
-
-            maxes = torch.tensor(
-                [torch.max(tensors[0][:, :, i]) for i in range(11, tensors[0].shape[2])]
-            )
-            mins = torch.tensor(
-                [torch.min(tensors[0][:, :, i]) for i in range(11, tensors[0].shape[2])]
-            )
-            normalize = lambda x: 2 * (x - mins) / (maxes - mins) - 1
-
-            if self.params.normalization == "tanh":
-                x[:, :, 11:] = normalize(x[:, :, 11:])
-                # x = normalize(x)
-            elif self.params.normalization == "sigmoid":
-                normalize = lambda x: (x - mins) / (maxes - mins)
-                x = normalize(x)
-
-        y = tensors[1]
-
-        if self.randomize_split:
-
-            false_indxes = (y == 0).nonzero().squeeze()
-            true_indxes = (y == 1).nonzero().squeeze()
-
-            all_false = x[false_indxes]
-            all_true = x[true_indxes]
-            # ipdb.set_trace()
-
-            all_true_train, all_true_test = train_test_split(
-                all_true, test_size=0.1, random_state=1
-            )
-            all_false_train, all_false_test = train_test_split(
-                all_false, test_size=0.1, random_state=1
+            self.normalization = self.params.normalization
+
+        if self.streaming:
+            # normalized per batch, from the statistics of the whole store
+            self.normalize_tensors(x_tensors, in_place=False)
+            self.y = y
+            self.train_idx, self.test_idx = load_split(
+                self.data_location, y.numpy(), test_size=0.1, seed=self.split_seed
             )
-
-            # ipdb.set_trace()
-            self.train_tensor = CustomDataset(all_true_train, all_false_train)
-
-            self.val_tensor = CustomDataset(all_true_test, all_false_test)
-
-            self.test_tensor = CustomDataset(all_true_test, all_false_test)
-
+            print("Shards of train data: ", len(self.shards))
+            return
+
+        shared = self.params.contains("shared_memory") and self.params.shared_memory
+        if shared:
+            # the creator of the segment normalizes it in place, once
+            prepare = lambda tensors: self.normalize_tensors(tensors[:-1])
+            prepare = None if self.compact else prepare
+            *x_tensors, y = self.share_tensors(x_tensors + [y], prepare)
+        if self.compact or not shared:
+            self.normalize_tensors(x_tensors, in_place=self.store is None)
+
+        self.device_resident = False
+        if self.params.contains("device_resident") and self.params.device_resident:
+            *x_tensors, y = self.resident_tensors(x_tensors + [y])
+
+        # every dataset here gathers a whole batch from an index tensor
+        if self.ragged:
+            self.dataset = RaggedDataset(*x_tensors, y)
+        elif shared and not self.device_resident:
+            names = list(self.shared.tensors)
+            self.dataset = SharedTensorDataset(self.shared, names)
         else:
+            self.dataset = TensorDataset(*x_tensors, y)
 
-            train_x, test_x, train_y, test_y = train_test_split(x, y, test_size=0.1)
-
-            self.train_tensor = TensorDataset(train_x, train_y)
-            self.val_tensor = TensorDataset(test_x, test_y)
-            self.test_tensor = TensorDataset(test_x, test_y)
-
-        print("Shape of train data: ", tensors[0].shape)
-
-    def _prepare_data(self):
-        # All data comumns except customer_ID, target, and S_2 are features
-        self.all_data = self.load_train_df(
-            os.path.join(self.data_location, "train.parquet"),
-            os.path.join(self.data_location, "train_labels.csv"),
+        # index arrays, the data itself stays in the store or segment
+        self.y = y.cpu()
+        self.train_idx, self.test_idx = load_split(
+            self.data_location, self.y.numpy(), test_size=0.1, seed=self.split_seed
         )
-        features = self.all_data.columns[2:-1]
-
-        # drop columns with more than 60% missing values
-        min_count = int(0.6 * self.all_data.shape[0] + 1)
-        self.all_data = self.all_data.dropna(axis=1, thresh=min_count)
-        ipdb.set_trace()
 
-        # drop all columns with same value in all rows
-        nonunique = self.all_data.nunique(0)
-        z_unique = nonunique[nonunique == 0].index
-        cols_to_drop = nonunique[nonunique == 1].index
-        tabular_cols = nonunique[nonunique < 10].index
-        ipdb.set_trace()
-
-        # self.all_data = self.all_data.loc[
-
-        # tabular_featue_columns = ["D_63" ,"D_64","D_68", "B_30" , "B_38", "D_114","D_117", "D_120", "D_126"
-        # binary_feature_columns = ["D_114", "D_120"]
-
-        # ipdb.set_trace()
-        self.all_data[features] = self.sc.fit_transform(self.all_data[features])
-        self.all_data[features] = self.all_data[features].fillna(-100)
-
-        # https://www.kaggle.com/competitions/amex-default-prediction/discussion/327828 !! Many Thanks @Chris Deotte for your sharing
-        all_tensor_x = torch.reshape(
-            torch.tensor(self.all_data[features].to_numpy()), (-1, 13, 188)
-        ).float()
-        all_tensor_y = torch.tensor(
-            self.all_data.groupby("customer_ID").first()["target"].to_numpy()
-        ).float()
-
-        X_trainval, X_test, y_trainval, y_test = train_test_split(
-            all_tensor_x, all_tensor_y, test_size=0.1, random_state=1
+        print("Shape of train data: ", x_tensors[0].shape)
+
+    def update_priorities(self, idx, losses):
+        # called by the model's training_step with the per-sample losses, the
+        # batches already prefetched by the DataLoader keep the old priorities
+        self.priority_sampler.update(idx.cpu().numpy(), losses.float().cpu().numpy())
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # prioritized training batches end with their indices and weights
+        sampled = []
+        if self.prioritized_sampling and self.trainer.training:
+            *batch, idx, weights = batch
+            sampled = [idx, weights]
+
+        # compact batches travel as uint8/float16/bits and ragged batches as
+        # their real statements, both are expanded on device
+        if self.compact or (self.ragged and self.pad_statements):
+            *x_tensors, y = batch
+            batch = [expand_x(self.header, x_tensors), y]
+        if self.normalize is not None:
+            # x, or the statements of unpadded ragged batches
+            self.normalize(batch[0])
+        return [*batch, *sampled]
+
+    def sharded_dataloader(self, indices, batch_size, shuffle=False):
+        dataset = ShardedDataset(
+            self.shards,
+            indices,
+            batch_size,
+            shuffle=shuffle,
+            shuffle_buffer=self.shuffle_buffer,
+            seed=self.split_seed,
         )
-        X_train, X_val, y_train, y_val = train_test_split(
-            X_trainval, y_trainval, test_size=0.1, random_state=1
-        )
-
-        # save tensors to file
-        tensor_dict = {
-            "x": all_tensor_x,
-            "y": all_tensor_y,
-        }
-        torch.save(tensor_dict, os.path.join(self.data_location, "tensor_n_dict.pt"))
-        print("Tensor saved.")
-
-        # TRAIN
-        self.train_tensor = TensorDataset(X_train, y_train)
-        # VAL
-        self.val_tensor = TensorDataset(X_val, y_val)
-        # TEST
-        self.test_tensor = TensorDataset(X_test, y_test)
+        # the dataset yields whole batches, like the samplers of batch_dataloader
+        return EpochDataLoader(dataset, batch_size=None, num_workers=self.num_workers)
 
     def train_dataloader(self):
-        # sampler =WeightedRandomSampler()
-        # class_one = t.sum(self.train_tensor.tensors[1] == 1)
-        # class_zero = t.sum(self.train_tensor.tensors[1] == 0)
-        # print("Class one: ", class_one)
-        # print("Class zero: ", class_zero)
-        # tot = class_one + class_zero
-
-        # # weight so that we sample equally from both classes
-        # w_class_1 = class_zero / class_one
-        # w_class_0 = 1
-
-        # weights = torch.tensor(
-        #     [0.3 if y == 1 else 0.1 for y in self.train_tensor.tensors[1]]
-        # )
+        if self.streaming:
+            return self.sharded_dataloader(self.train_idx, self.train_batch_size, True)
+
+        if self.prioritized_sampling:
+            # created once, the priorities carry over from epoch to epoch
+            if self.priority_sampler is None:
+                self.priority_sampler = PrioritizedBatchSampler(
+                    self.train_idx,
+                    self.train_batch_size,
+                    alpha=self.priority_alpha,
+                    beta=self.priority_beta,
+                    epoch_length=self.epoch_length,
+                )
+            return DataLoader(
+                SampledDataset(self.dataset),
+                sampler=self.priority_sampler,
+                batch_size=None,
+                num_workers=self.num_workers,
+            )
 
-        # # ipdb.set_trace()
+        if self.balanced_sampling:
+            sampler = BalancedBatchSampler(
+                self.train_idx,
+                self.y,
+                self.train_batch_size,
+                pos_ratio=self.pos_ratio,
+                epoch_length=self.epoch_length,
+            )
+            return self.batch_dataloader(sampler)
 
-        # sampler = WeightedRandomSampler(
-        #     weights, num_samples=len(weights), replacement=True
-        # )
+        sampler = BatchIndexSampler(self.train_idx, self.train_batch_size, shuffle=True)
+        return self.batch_dataloader(sampler)
 
+    def batch_dataloader(self, sampler):
+        # batch_size=None: the sampler yields whole batches of indices and the
+        # dataset gathers each batch at once, no per-sample calls or collate
         return DataLoader(
-            self.train_tensor,
-            # sampler=sampler,
-            batch_size=self.train_batch_size,
+            self.dataset,
+            sampler=sampler,
+            batch_size=None,
             num_workers=self.num_workers,
-            shuffle=True,
         )
 
     def val_dataloader(self):
-        return DataLoader(
-            self.val_tensor,
-            batch_size=self.test_batch_size,
-            num_workers=self.num_workers,
-        )
+        if self.streaming:
+            return self.sharded_dataloader(self.test_idx, self.test_batch_size)
+        sampler = BatchIndexSampler(self.test_idx, self.test_batch_size)
+        return self.batch_dataloader(sampler)
 
     def test_dataloader(self):
-        return DataLoader(
-            self.test_tensor,
-            batch_size=self.test_batch_size,
-            num_workers=self.num_workers,
-        )
-
-
-class CustomDataset(Dataset):
-    def __init__(self, false_samples: t.Tensor, true_samples: t.Tensor):
-
-        self.false_samples = false_samples
-        self.true_samples = true_samples
-
-        # length is minimum of the two
-        self.length = min(self.false_samples.shape[0], self.true_samples.shape[0])
-        self.true_sample_size = self.true_samples.shape[0]
-        self.false_sample_size = self.false_samples.shape[0]
-        print("False samples: ", self.false_samples.shape)
-        print("True samples: ", self.true_samples.shape)
-
-    def __len__(self):
-        return 100000
-
-    def __getitem__(self, idx):
-
-        # randomly return false or true
-        if torch.rand(1)[0] > 0.5:
-            idx = torch.randint(0, self.false_sample_size, (1,))[0]
-            return self.false_samples[idx], t.zeros(1)
-
-        else:
-            idx = torch.randint(0, self.true_sample_size, (1,))[0]
-            return self.true_samples[idx], t.ones(1)
-
-        return false_sample, true_sample
-
-        return self.data[idx], self.target[idx]
+        if self.streaming:
+            return self.sharded_dataloader(self.test_idx, self.test_batch_size)
+        sampler = BatchIndexSampler(self.test_idx, self.test_batch_size)
+        return self.batch_dataloader(sampler)
@@ -0,0 +1,113 @@
+import torch as t
+from torch.utils.data import Dataset, Sampler
+
+
+class BatchIndexSampler(Sampler):
+    """
+    yields whole batches as index tensors, for a DataLoader with
+    batch_size=None: the dataset then gathers a batch with one fancy index per
+    tensor (TensorDataset and the datasets here accept index tensors) instead
+    of batch_size __getitem__ calls and a default collate
+    """
+
+    def __init__(self, indices, batch_size, shuffle=False, drop_last=False, seed=None):
+        self.indices = t.as_tensor(indices, dtype=t.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = t.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[t.randperm(len(indices), generator=self.generator)]
+
+        for batch in range(len(self)):
+            idx = indices[batch * self.batch_size : (batch + 1) * self.batch_size]
+            # sorted within the batch: forward reads over a memory mapped store
+            yield idx.sort()[0]
+
+
+class BalancedBatchSampler(Sampler):
+    """
+    class-balanced batches for a DataLoader with batch_size=None: every batch
+    holds round(pos_ratio * batch_size) positives, each class drawn uniformly
+    with replacement in one vectorized call. An epoch is epoch_length batches,
+    by default as many as one pass over indices.
+    """
+
+    def __init__(
+        self, indices, y, batch_size, pos_ratio=0.5, epoch_length=None, seed=None
+    ):
+        indices = t.as_tensor(indices, dtype=t.long)
+        labels = t.as_tensor(y)[indices]
+        self.positives = indices[labels == 1]
+        self.negatives = indices[labels != 1]
+        self.n_positives = int(round(pos_ratio * batch_size))
+        self.n_negatives = batch_size - self.n_positives
+        if self.n_positives > 0 and len(self.positives) == 0:
+            raise ValueError("no positive samples to draw from")
+        if self.n_negatives > 0 and len(self.negatives) == 0:
+            raise ValueError("no negative samples to draw from")
+
+        self.epoch_length = epoch_length or len(indices) // batch_size
+        self.generator = t.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return self.epoch_length
+
+    def draw(self, samples, n):
+        return samples[t.randint(len(samples), (n,), generator=self.generator)]
+
+    def __iter__(self):
+        for _ in range(self.epoch_length):
+            positives = self.draw(self.positives, self.n_positives)
+            negatives = self.draw(self.negatives, self.n_negatives)
+            yield t.cat([positives, negatives]).sort()[0]
+
+
+class RaggedDataset(Dataset):
+    """
+    customers of a ragged store: a sample is the (length, F) block of its real
+    statements and its label. Given an index tensor it gathers the whole batch
+    at once, as (statements, lengths, y).
+    """
+
+    def __init__(self, statements, offsets, lengths, y):
+        self.statements = statements
+        self.offsets = offsets
+        self.lengths = lengths
+        self.y = y
+
+    def __len__(self):
+        return self.lengths.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, t.Tensor) and idx.dim() == 1:
+            return self.get_batch(idx)
+        start, stop = self.offsets[idx], self.offsets[idx + 1]
+        return self.statements[start:stop], self.y[idx]
+
+    def get_batch(self, idx):
+        idx = idx.to(self.lengths.device)
+        lengths = self.lengths[idx]
+        counts = lengths.long()
+        # row of every statement of the batch: its customer offset + its slot
+        starts = t.repeat_interleave(self.offsets[idx], counts)
+        first = t.repeat_interleave(t.cumsum(counts, 0) - counts, counts)
+        rows = starts + t.arange(len(starts), device=idx.device) - first
+        return self.statements[rows], lengths, self.y[idx]
+
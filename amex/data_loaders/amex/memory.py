@@ -0,0 +1,57 @@
+import threading
+
+"""
+resident memory of the process, to report the peak of each preprocessing stage.
+The peak is sampled from /proc on a thread while the stage runs, so that, unlike
+ru_maxrss, it is the peak of the stage and not of the process so far.
+"""
+
+
+def current_rss():
+    # resident set size in bytes, 0 where /proc is not available
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class PeakRSS:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class StageReport:
+    # peak RSS of named stages, printed as a table
+    def __init__(self):
+        self.stages = []
+
+    def stage(self, name):
+        rss = PeakRSS()
+        self.stages.append((name, rss))
+        return rss
+
+    def print(self):
+        print(f"{'stage':<12}{'peak RSS GB':>14}")
+        for name, rss in self.stages:
+            print(f"{name:<12}{rss.peak / 1024**3:>14.3f}")
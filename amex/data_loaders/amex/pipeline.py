@@ -0,0 +1,226 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import compression, customer_index, preprocess, profiler, stats, tensor_store
+from .preprocess import (
+    encoded_chunks,
+    iter_customer_chunks,
+    load_category_codes,
+    memory_budget,
+    save_category_codes,
+    write_store,
+)
+from .profiler import load_schema, profile_parquet, save_schema, select_columns
+
+"""
+the preprocessing as a chain of cached stages: profile -> encode -> store. The
+artifact of a stage is a directory of the cache named after the stage and a
+hash of its inputs (file fingerprints, or the keys of the stages they come
+from), its parameters and the source of the code it runs. A stage is skipped
+when its artifact exists, so a re-run resumes after the last completed stage
+and a parameter change only redoes the stages downstream of it. The store is
+published as a tensor_store symlink to the cached artifact.
+
+    python -m amex.data_loaders.amex.pipeline --thresh 0.6 --layout compact
+"""
+
+done_file = "done.json"
+
+
+def fingerprint(path):
+    # artifacts are identified by their key, files by size and modification time
+    path = os.path.abspath(path)
+    if os.path.exists(os.path.join(path, done_file)):
+        return os.path.basename(path)
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def code_version(modules):
+    sources = [inspect.getsource(module) for module in modules]
+    return hashlib.sha1("".join(sources).encode()).hexdigest()
+
+
+class Pipeline:
+    def __init__(self, cache_dir="pipeline_cache"):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+
+    def run(self, name, function, inputs, params, modules, **options):
+        """
+        runs function(output_dir, *inputs, **params, **options) unless its
+        artifact is cached, returns the artifact directory. options do not
+        change the result (e.g. the memory budget) and are not part of the key.
+        The function writes into a temporary directory that is renamed once it
+        returns, so a crashed stage leaves no artifact behind.
+        """
+        key = {
+            "stage": name,
+            "inputs": [fingerprint(path) for path in inputs],
+            "params": params,
+            "code": code_version(modules),
+        }
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        output = os.path.join(self.cache_dir, f"{name}-{digest[:16]}")
+        if os.path.exists(os.path.join(output, done_file)):
+            print("Cached stage:", name, output)
+            return output
+
+        tmp_dir = output + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        print("Running stage:", name)
+        function(tmp_dir, *inputs, **params, **options)
+        with open(os.path.join(tmp_dir, done_file), "w") as file:
+            json.dump(key, file, indent=4)
+        shutil.rmtree(output, ignore_errors=True)
+        os.replace(tmp_dir, output)
+        return output
+
+
+def profile_stage(output, path, max_distinct=12, budget=memory_budget):
+    schema = profile_parquet(path, max_distinct, budget)
+    save_schema(schema, os.path.join(output, "schema.json"))
+
+
+def encode_stage(output, path, profile, thresh=0.6, budget=memory_budget):
+    # the kept columns of the complete customers, with encoded categoricals
+    schema = load_schema(os.path.join(profile, "schema.json"))
+    features, category_codes = select_columns(schema, thresh)
+
+    encoded_file = os.path.join(output, "encoded.parquet")
+    writer = None
+    for chunk in encoded_chunks(path, features, category_codes, budget):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(encoded_file, table.schema)
+        writer.write_table(table)
+    if writer is None:
+        raise ValueError(f"{path} has no rows to encode")
+    writer.close()
+
+    save_category_codes(category_codes, os.path.join(output, "category_codes.json"))
+    with open(os.path.join(output, "encoded.json"), "w") as file:
+        summary = {"n_customers": schema["n_customers"], "n_rows": schema["n_rows"]}
+        json.dump({"features": features, **summary}, file, indent=4)
+
+
+def store_stage(
+    output,
+    encode,
+    labels,
+    layout="dense",
+    continuous_dtype="float16",
+    shards=False,
+    codec=None,
+    budget=memory_budget,
+):
+    with open(os.path.join(encode, "encoded.json")) as file:
+        encoded = json.load(file)
+    features = encoded["features"]
+    encoded_file = os.path.join(encode, "encoded.parquet")
+    category_codes = load_category_codes(os.path.join(encode, "category_codes.json"))
+    columns = ["customer_ID", "S_2"] + features
+    chunks = iter_customer_chunks(encoded_file, columns, budget)
+    write_store(
+        output,
+        chunks,
+        features,
+        encoded["n_customers"],
+        encoded["n_rows"],
+        labels,
+        layout,
+        continuous_dtype,
+        shards,
+        codec,
+        n_categorical=len(category_codes),
+    )
+
+
+def publish(artifact, link):
+    # tensor_store -> the cached store, swapped atomically
+    if os.path.isdir(link) and not os.path.islink(link):
+        raise ValueError(f"{link} is a directory, move it before publishing")
+    tmp_link = link + ".tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.abspath(artifact), tmp_link)
+    os.replace(tmp_link, link)
+
+
+def run_pipeline(
+    path=preprocess.data_location,
+    labels=preprocess.train_labels,
+    thresh=0.6,
+    layout="dense",
+    continuous_dtype="float16",
+    shards=False,
+    codec=None,
+    budget=memory_budget,
+    cache_dir="pipeline_cache",
+):
+    # the memory budget only bounds the working memory, it is not part of a key
+    pipeline = Pipeline(cache_dir)
+    code = [preprocess, profiler, customer_index]
+    profile = pipeline.run(
+        "profile", profile_stage, [path], {}, [profiler], budget=budget
+    )
+    encode = pipeline.run(
+        "encode",
+        encode_stage,
+        [path, profile],
+        {"thresh": thresh},
+        code,
+        budget=budget,
+    )
+    store = pipeline.run(
+        "store",
+        store_stage,
+        [encode, labels],
+        {
+            "layout": layout,
+            "continuous_dtype": continuous_dtype,
+            "shards": shards,
+            "codec": codec,
+        },
+        code + [tensor_store, stats, compression],
+        budget=budget,
+    )
+
+    # the files the rest of the code expects in the data directory
+    shutil.copy(os.path.join(profile, "schema.json"), "schema.json")
+    shutil.copy(os.path.join(encode, "category_codes.json"), "category_codes.json")
+    publish(store, preprocess.tensor_store)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thresh", type=float, default=0.6)
+    parser.add_argument("--memory-budget", type=float, default=memory_budget / 1024**3)
+    parser.add_argument(
+        "--layout", choices=["dense", "compact", "ragged"], default="dense"
+    )
+    parser.add_argument(
+        "--continuous-dtype", choices=["float16", "bfloat16"], default="float16"
+    )
+    parser.add_argument("--shards", action="store_true")
+    parser.add_argument("--codec", choices=["zstd", "lz4", "zlib"], default=None)
+    parser.add_argument("--cache-dir", default="pipeline_cache")
+    args = parser.parse_args()
+
+    run_pipeline(
+        thresh=args.thresh,
+        layout=args.layout,
+        continuous_dtype=args.continuous_dtype,
+        shards=args.shards,
+        codec=args.codec,
+        budget=args.memory_budget * 1024**3,
+        cache_dir=args.cache_dir,
+    )
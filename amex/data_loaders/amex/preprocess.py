@@ -1,132 +1,462 @@
 import pandas as pd
 import numpy as np
-import ipdb
-from pyparsing import col
-import torch as t
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .customer_index import encode_ids, join_labels, key_dtype, load_labels
+from .memory import StageReport
+from .profiler import profile_parquet, select_columns, save_schema
+from .stats import FeatureStats, save_stats, stats_file
+from .tensor_store import (
+    TensorStoreWriter,
+    is_sharded_store,
+    load_header,
+    load_shards,
+    save_shards_index,
+    save_tensor_store,
+    shard_path,
+)
 
 data_location = "train_data.parquet"
 train_labels = "train_labels.csv"
+tensor_store = "tensor_store"
+test_location = "test.parquet"
+test_store = "test_store"
 
+# customer_IDs are stored as their 32 byte keys, see customer_index
+customer_id_dtype = key_dtype
 
-def load_data():
-    df = pd.read_parquet(data_location)
-    return df
-
-
-"""
-fills the rest of missing sequences by NA
-"""
-
-
-def fill_missing_time(df):
-    df["S_2"] = pd.to_datetime(df["S_2"])
-    tmp = df[["customer_ID", "S_2"]].groupby("customer_ID").count()
-
-    missing_cids = []
-    for nb_available_rows in range(1, 14):
-        cids = tmp[tmp["S_2"] == nb_available_rows].index.values
-        batch_missing_cids = [
-            cid for cid in cids for _ in range(13 - nb_available_rows)
-        ]
-        missing_cids.extend(batch_missing_cids)
+# S_2 is always a plain date, parsed without format inference
+date_format = "%Y-%m-%d"
 
-    train_part2 = df.iloc[: len(missing_cids)].copy()
-    train_part2.loc[:] = np.nan  # fill the rest with nan
-    train_part2["customer_ID"] = missing_cids
+# working memory (bytes) the streaming mode may hold per batch of input rows
+memory_budget = 8 * 1024**3
 
-    train = pd.concat([train_part2, df])
 
-    train = train.sort_values("customer_ID")
-
-    print("Filled missing time:", len(missing_cids))
-
-    return train
-
-
-def drop_na_column(df: pd.DataFrame, thresh=0.6):
-
-    thresh = int(thresh * df.shape[0])
-    df = df.dropna(axis=1, thresh=thresh)
-    # df.fillna(value=None)  # Fill None with nan!
+def load_data(columns=None, lean=False):
+    # columns: read only these, e.g. the ones select_columns keeps
+    if lean:
+        return read_lean(data_location, columns)
+    df = pd.read_parquet(data_location, columns=columns)
     return df
 
 
-def process_tabular(df):
-
-    print("Processing tabular data")
-
-    nununique = df.nunique(0)
-
-    max = 12
-    columns = []
-    for i in range(max):
-        idx = (nununique[nununique == i + 1]).index
-
-        if len(idx) > 0:
-            process_tabular_column(df, idx, i + 1)
-            columns.append((idx, i + 1))
+def read_lean(path, columns=None):
+    """
+    reads a parquet file with float64 columns downcast to float32 in arrow,
+    before pandas sees them. Every column gets its own block, so a column
+    deleted from the frame frees its memory, and the arrow buffers are released
+    while converting.
+    """
+    table = pq.read_table(path, columns=columns)
+    schema = pa.schema(
+        [
+            field.with_type(pa.float32()) if field.type == pa.float64() else field
+            for field in table.schema
+        ]
+    )
+    table = table.cast(schema)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
 
-    c_ordered = ["customer_ID", "S_2"]
-    try:
-        for i in range(len(columns)):
-            c_ordered.extend(columns[i][0].tolist())
-            print(columns[i][0], columns[i][1])
 
-        remaining_columns = [col for col in df.columns[2:] if col not in c_ordered]
-        c_ordered.extend(remaining_columns)
+"""
+places every row at its (customer, statement) slot; customers without 13
+statements keep NaN rows at the end, as the padding did before
+"""
 
-        df = df.loc[:, c_ordered]
-    except:
-        ipdb.set_trace()
 
-    print("Processed tabular:", len(c_ordered))
+def statement_slots(df: pd.DataFrame):
+    # rows ordered by customer and date: the slot of a row is its groupby
+    # cumcount within the customer, i.e. its offset from the customer start.
+    # cids are the sorted customer keys
+    keys = encode_ids(df["customer_ID"].to_numpy())
+    cids, codes = np.unique(keys, return_inverse=True)
+    dates = pd.to_datetime(df["S_2"], format=date_format)
+    dates = dates.to_numpy().view(np.int64)
+    order = np.lexsort((dates, codes))
+    codes = codes[order]
+
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    counts = np.diff(np.append(starts, len(codes)))
+    slots = np.arange(len(codes)) - np.repeat(starts, counts)
+    return order, codes, slots, cids
+
+
+def dense_statements(
+    df: pd.DataFrame, features, max_statements=13, slots=None, lean=False
+):
+    # lean: the columns are deleted from df once scattered, df ends up empty
+    order, codes, slots, cids = statement_slots(df) if slots is None else slots
+    if lean:
+        del df["customer_ID"], df["S_2"]
+    if len(slots) > 0 and slots.max() >= max_statements:
+        raise ValueError(f"customers with more than {max_statements} statements")
+
+    tensor = np.full(
+        (len(cids), max_statements, len(features)), np.nan, dtype=np.float32
+    )
+    # scatter column by column so that no (rows, features) copy is made
+    for i, column in enumerate(features):
+        values = df.pop(column) if lean else df[column]
+        values = values.to_numpy(dtype=np.float32, na_value=np.nan)
+        tensor[codes, slots, i] = values[order]
+        del values
+
+    print("Filled missing time:", tensor.shape[0] * max_statements - len(codes))
+
+    # number of real statements per customer, they come first in the tensor
+    lengths = np.bincount(codes, minlength=len(cids))
+    return tensor, cids, lengths
+
+
+def process_tabular_column(df: pd.DataFrame, columns, category_codes=None, workers=None):
+    """
+    reformats the values of every column to codes from 0 to the number of
+    classes - 1, in sorted value order, with one pass over each column.
+    category_codes maps a column to its sorted values; columns missing from it
+    are fitted here. Returns the mapping of all columns, so that the same codes
+    can be applied at inference time.
+    """
+    category_codes = {} if category_codes is None else category_codes
+
+    def encode(column):
+        if column in category_codes:
+            # in the dtype of the column: float64 codes do not match float32
+            # values read in lean mode, unless they are integers
+            values = pd.Index(category_codes[column]).astype(df[column].dtype)
+            codes = values.get_indexer(df[column])
+        else:
+            codes, values = pd.factorize(df[column], sort=True)
+        codes = codes.astype(np.float32)
+        codes[codes < 0] = np.nan  # missing or unseen values
+        return column, codes, np.asarray(values)
+
+    # pandas releases the GIL while hashing, so columns are encoded in parallel
+    with ThreadPoolExecutor(workers) as pool:
+        encoded = list(pool.map(encode, columns))
+
+    fitted = {}
+    for column, codes, values in encoded:
+        df[column] = codes
+        fitted[column] = values
+    return fitted
+
+
+def save_category_codes(category_codes, path="category_codes.json"):
+    with open(path, "w") as file:
+        json.dump({k: np.asarray(v).tolist() for k, v in category_codes.items()}, file)
+
+
+def load_category_codes(path="category_codes.json"):
+    with open(path) as file:
+        return {k: np.asarray(v) for k, v in json.load(file).items()}
+
+
+def save_tensor(
+    df,
+    layout="dense",
+    continuous_dtype="float16",
+    codec=None,
+    lean=False,
+    n_categorical=None,
+):
+    # n_categorical: the categorical columns come first, see select_columns
+    labels = load_labels(train_labels)
+    features = list(df.columns[2:])
+    tensor, cids, lengths = dense_statements(df, features, lean=lean)
+    y = join_labels(labels, cids)
+    save_tensor_store(
+        tensor_store,
+        tensor,
+        y,
+        features,
+        layout,
+        continuous_dtype,
+        lengths=lengths,
+        codec=codec,
+        n_categorical=n_categorical,
+        customer_ids=cids,
+    )
+    # normalization statistics, from the float32 values before compaction
+    stats = FeatureStats(len(features))
+    stats.update(tensor)
+    save_stats(tensor_store, stats, len(cids))
 
+    print("Saved tensor")
     return df
 
 
-def process_tabular_column(df: pd.DataFrame, columns, enum_classes):
-
-    # reformat values in df[column] to start from 0 and end to number of enum_classes
-    for column in columns:
-        uniques = df[column].unique().tolist()
-        uniques = [item for item in uniques if not pd.isna(item)]
-        uniques = sorted(uniques)
-
-        reformated_values = np.arange(enum_classes)
-
-        for i in range(len(uniques)):
-            try:
-                if uniques[i] == reformated_values[i]:
-                    continue
-            except:
-                ipdb.set_trace()
-
-            df[column] = df[column].replace(uniques[i], reformated_values[i])
-
-
-def save_tensor(df):
-    labels = pd.read_csv(train_labels)
-    labels = labels.sort_values("customer_ID")
-    df = df.sort_values(["customer_ID", "S_2"])  # sort by customer_ID and time
-    df.fillna(value=np.nan)  # Fill None with nan
-    tensor = df[df.columns[2:]].to_numpy()
-    # ipdb.set_trace()
-    tensor = t.reshape(t.tensor(tensor, dtype=t.float), (-1, 13, 157))
-    all_tensor_y = t.tensor(labels["target"].to_numpy(), dtype=t.float)
-    dict = {"x": tensor, "y": all_tensor_y}
-    t.save(dict, "tensor.pt")
-
-    print("Saved tensor")
+def preprocess(
+    thresh=0.6, layout="dense", continuous_dtype="float16", codec=None, lean=False
+):
+    """
+    the dropped and categorical columns are decided from the profile, so only
+    the kept columns are read, already in their final order. lean: float32 on
+    read and every column freed once it is in the tensor (the returned frame is
+    then empty). Prints the peak RSS of every stage.
+    """
+    report = StageReport()
+    with report.stage("profile"):
+        schema = profile_parquet(data_location)
+        save_schema(schema)
+        features, category_codes = select_columns(schema, thresh)
+
+    with report.stage("read"):
+        df = load_data(["customer_ID", "S_2"] + features, lean)
+    with report.stage("encode"):
+        process_tabular_column(df, list(category_codes), category_codes)
+        save_category_codes(category_codes)
+    with report.stage("tensor"):
+        n_categorical = len(category_codes)
+        save_tensor(df, layout, continuous_dtype, codec, lean, n_categorical)
+    report.print()
     return df
 
 
-def preprocess():
-    df = load_data()
-    df = fill_missing_time(df)
-    df = drop_na_column(df)
-    df = process_tabular(df)
-    save_tensor(df)
-    return df
+"""
+streaming mode: reads the parquet file batch by batch (pyarrow walks the row
+groups) so that peak memory is bounded by the budget, not by the input size
+"""
 
 
-preprocess()
+def rows_per_batch(parquet_file: pq.ParquetFile, budget=memory_budget):
+    # a row is held as arrow and pandas (8 bytes per value, twice over padding)
+    # and, in the worst case of a single statement customer, as 13 float32 rows
+    num_columns = parquet_file.metadata.num_columns
+    row_bytes = num_columns * 8 * 3 + 13 * num_columns * 4
+    return max(13, int(budget // row_bytes))
+
+
+def iter_customer_chunks(path, columns, budget=memory_budget):
+    """
+    yields dataframes holding complete customers only: the rows of the last
+    customer of a batch are carried over to the next batch
+    """
+    parquet_file = pq.ParquetFile(path)
+    batch_size = rows_per_batch(parquet_file, budget)
+
+    carry = None
+    last_cid = None
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        df = batch.to_pandas()
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        del batch
+
+        cids = df["customer_ID"].to_numpy()
+        if (cids[1:] < cids[:-1]).any() or (last_cid is not None and cids[0] < last_cid):
+            raise ValueError("streaming mode needs the rows sorted by customer_ID")
+
+        split = np.flatnonzero(cids != cids[-1])
+        split = split[-1] + 1 if len(split) > 0 else 0
+        carry = df.iloc[split:]
+        last_cid = cids[-1]
+
+        if split > 0:
+            yield df.iloc[:split]
+
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def encoded_chunks(path, features, category_codes, budget=memory_budget):
+    # complete customers of the kept columns, categorical columns encoded
+    columns = ["customer_ID", "S_2"] + features
+    for chunk in iter_customer_chunks(path, columns, budget):
+        process_tabular_column(chunk, list(category_codes), category_codes)
+        yield chunk
+
+
+def write_store(
+    store,
+    chunks,
+    features,
+    n_customers,
+    n_rows,
+    labels_file=train_labels,
+    layout="dense",
+    continuous_dtype="float16",
+    shards=False,
+    codec=None,
+    compute_stats=True,
+    n_categorical=None,
+):
+    """
+    writes chunks (encoded frames of complete customers, in customer_ID order)
+    as a tensor store, with the customer_ID of every row and the normalization
+    statistics. shards: one tensor store per chunk instead of a single store
+    (n_customers and n_rows are then not needed). Without labels_file (test
+    data) the store has no y; without compute_stats no statistics are saved.
+    n_categorical: the number of categorical columns, the first ones.
+    """
+    labels = None
+    if labels_file is not None:
+        labels = load_labels(labels_file)
+    if not shards:
+        writer = TensorStoreWriter(store, features, codec)
+        shape = (n_customers, 13, len(features))
+        writer.create_x(
+            shape,
+            layout,
+            n_categorical,
+            continuous_dtype=continuous_dtype,
+            n_statements=n_rows,
+        )
+        writer.create("customer_ID", (n_customers,), customer_id_dtype)
+        if labels is not None:
+            writer.create("y", (n_customers,), np.float32)
+    stats = FeatureStats(len(features))
+    sizes = []
+
+    for chunk in chunks:
+        tensor, cids, lengths = dense_statements(chunk, features)
+        y = None if labels is None else join_labels(labels, cids)
+        if shards:
+            shard_store = shard_path(store, len(sizes))
+            with TensorStoreWriter(shard_store, features, codec) as shard:
+                shard.create_x(
+                    tensor.shape,
+                    layout,
+                    n_categorical,
+                    continuous_dtype=continuous_dtype,
+                    n_statements=int(lengths.sum()),
+                )
+                shard.append_x(tensor, lengths)
+                shard.write("customer_ID", cids)
+                if y is not None:
+                    shard.write("y", np.asarray(y, dtype=np.float32))
+        else:
+            writer.append_x(tensor, lengths)
+            writer.append("customer_ID", cids)
+            if y is not None:
+                writer.append("y", y)
+        if compute_stats:
+            stats.update(tensor)
+        sizes.append(len(cids))
+        print("Streamed customers:", sum(sizes), "/", n_customers or "?")
+
+    if shards:
+        save_shards_index(store, sizes, columns=features, layout=layout)
+    else:
+        writer.close()
+    if compute_stats:
+        save_stats(store, stats, sum(sizes))
+
+
+def preprocess_streaming(
+    path=data_location,
+    thresh=0.6,
+    budget=memory_budget,
+    layout="dense",
+    continuous_dtype="float16",
+    shards=False,
+    codec=None,
+):
+    schema = profile_parquet(path, budget=budget)
+    save_schema(schema)
+    features, classes = select_columns(schema, thresh)
+    n_customers = schema["n_customers"]
+    print("Selected columns:", len(features), "customers:", n_customers)
+
+    write_store(
+        tensor_store,
+        encoded_chunks(path, features, classes, budget),
+        features,
+        n_customers,
+        schema["n_rows"],
+        layout=layout,
+        continuous_dtype=continuous_dtype,
+        shards=shards,
+        codec=codec,
+        n_categorical=len(classes),
+    )
+    save_category_codes(classes)
+
+    print("Saved streamed tensor")
+
+
+def preprocess_test(
+    path=test_location,
+    output=test_store,
+    train_store=tensor_store,
+    budget=memory_budget,
+    codec=None,
+):
+    """
+    streams the test parquet into a sharded store with the columns, category
+    codes, layout and normalization statistics of the training store: nothing
+    is fitted on the test data. Every shard holds the customer_ID of its rows.
+    """
+    if is_sharded_store(train_store):
+        header = load_header(load_shards(train_store)[0][0])
+    else:
+        header = load_header(train_store)
+    features = header["columns"]
+    category_codes = load_category_codes()
+
+    write_store(
+        output,
+        encoded_chunks(path, features, category_codes, budget),
+        features,
+        None,
+        None,
+        labels_file=None,
+        layout=header.get("layout", "dense"),
+        continuous_dtype=header.get("continuous_dtype", "float16"),
+        shards=True,
+        codec=codec,
+        compute_stats=False,
+        n_categorical=len(category_codes),
+    )
+    # test batches are normalized with the training statistics
+    if os.path.exists(os.path.join(train_store, stats_file)):
+        shutil.copy(os.path.join(train_store, stats_file), output)
+    else:
+        print("No normalization statistics in", train_store)
+
+    print("Saved test store")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--memory-budget", type=float, default=memory_budget / 1024**3)
+    parser.add_argument(
+        "--layout", choices=["dense", "compact", "ragged"], default="dense"
+    )
+    parser.add_argument(
+        "--continuous-dtype", choices=["float16", "bfloat16"], default="float16"
+    )
+    # with --streaming, one store per chunk of the memory budget
+    parser.add_argument("--shards", action="store_true")
+    # compresses the store chunk by chunk (zstd and lz4 need their packages)
+    parser.add_argument("--codec", choices=["zstd", "lz4", "zlib"], default=None)
+    # test.parquet to a sharded test_store, with the training columns and codes
+    parser.add_argument("--test", action="store_true")
+    # in memory mode with float32 columns, freed as soon as they are used
+    parser.add_argument("--lean", action="store_true")
+    args = parser.parse_args()
+
+    if args.test:
+        preprocess_test(budget=args.memory_budget * 1024**3, codec=args.codec)
+    elif args.streaming:
+        budget = args.memory_budget * 1024**3
+        preprocess_streaming(
+            budget=budget,
+            layout=args.layout,
+            continuous_dtype=args.continuous_dtype,
+            shards=args.shards,
+            codec=args.codec,
+        )
+    else:
+        preprocess(
+            layout=args.layout,
+            continuous_dtype=args.continuous_dtype,
+            codec=args.codec,
+            lean=args.lean,
+        )
@@ -0,0 +1,126 @@
+import numpy as np
+import torch as t
+from torch.utils.data import Dataset, Sampler
+
+"""
+prioritized sampling: every training sample has a priority (its last loss), and
+batches are drawn with probability proportional to priority ** alpha. The
+priorities live in a sum-tree stored as a flat array (node i has children 2i and
+2i + 1, the leaves start at capacity), which is updated and searched one tree
+level at a time for the whole batch, i.e. in O(batch * log N) numpy operations.
+"""
+
+
+class SumTree:
+    def __init__(self, size):
+        self.size = size
+        self.capacity = 1 << max(int(size - 1).bit_length(), 0)
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = np.zeros(2 * self.capacity)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def leaves(self):
+        return self.tree[self.capacity : self.capacity + self.size]
+
+    def update(self, positions, priorities):
+        # positions may repeat, the last priority given wins
+        nodes = np.asarray(positions) + self.capacity
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes)
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # positions of the leaves whose cumulative priority range holds values
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values > self.tree[left]
+            values -= np.where(right, self.tree[left], 0)
+            nodes = left + right
+        # float rounding can walk past the last real leaf
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+
+class PrioritizedBatchSampler(Sampler):
+    """
+    batches of indices drawn in proportion to their priority, for a
+    DataLoader with batch_size=None over a SampledDataset: yields (indices,
+    importance weights), the weights (N * P(i)) ** -beta normalized by their
+    batch maximum. Every sample starts at priority 1. The DataLoader draws
+    num_workers * prefetch_factor batches ahead, so an update() only reaches
+    the batches drawn after it: priorities lag by the prefetch depth.
+    """
+
+    def __init__(
+        self,
+        indices,
+        batch_size,
+        alpha=0.6,
+        beta=0.4,
+        epoch_length=None,
+        epsilon=1e-3,
+        seed=None,
+    ):
+        # sorted, update() looks the dataset indices up by binary search
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        self.batch_size = batch_size
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.epoch_length = epoch_length or len(self.indices) // batch_size
+        self.rng = np.random.default_rng(seed)
+
+        self.tree = SumTree(len(self.indices))
+        self.tree.update(np.arange(len(self.indices)), 1.0)
+
+    def __len__(self):
+        return self.epoch_length
+
+    def sample(self):
+        # stratified: one uniform draw in each of batch_size equal segments
+        segment = self.tree.total / self.batch_size
+        values = np.arange(self.batch_size) + self.rng.random(self.batch_size)
+        values = values * segment
+        positions = np.sort(self.tree.find(values))
+
+        probabilities = self.tree.leaves()[positions] / self.tree.total
+        weights = (len(self.indices) * probabilities) ** -self.beta
+        weights = weights / weights.max()
+        return (
+            t.from_numpy(self.indices[positions]),
+            t.from_numpy(weights.astype(np.float32)),
+        )
+
+    def __iter__(self):
+        for _ in range(self.epoch_length):
+            yield self.sample()
+
+    def update(self, indices, losses):
+        # indices: dataset indices of the batch, losses: their per-sample loss
+        indices = np.asarray(indices, dtype=np.int64)
+        positions = np.searchsorted(self.indices, indices)
+        priorities = (np.asarray(losses, dtype=np.float64) + self.epsilon) ** self.alpha
+        self.tree.update(positions, priorities)
+
+
+class SampledDataset(Dataset):
+    """
+    passes the (indices, weights) of a PrioritizedBatchSampler through: a
+    batch is the batch of dataset followed by its indices and weights
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        idx, weights = item
+        return (*self.dataset[idx], idx, weights)
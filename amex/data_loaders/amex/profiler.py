@@ -0,0 +1,172 @@
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+
+"""
+profiles every column of a parquet file in a single pass over its row groups:
+non-null count, exact number of distinct values up to max_distinct, min/max.
+The parquet statistics are used instead of the data wherever they can be
+trusted, the remaining columns are read one row group at a time.
+"""
+
+
+# the key columns, never categorical
+key_columns = ("customer_ID", "S_2")
+
+# bytes of column data profile_parquet reads at once
+read_budget = 256 * 1024**2
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def profile_parquet(path, max_distinct=12, budget=read_budget):
+    """
+    budget: bytes of column data read at once, a row group is read a few
+    columns at a time. Distinct values are only kept while a column has at most
+    max_distinct of them, and never for customer_ID and S_2.
+    """
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    arrow_schema = parquet_file.schema_arrow
+    columns = arrow_schema.names
+
+    null_counts = dict.fromkeys(columns, 0)
+    minimums = dict.fromkeys(columns)
+    maximums = dict.fromkeys(columns)
+    # None once a column has more than max_distinct values
+    distinct = {column: None if column in key_columns else set() for column in columns}
+
+    n_customers = 0
+    last_cid = None
+
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+
+        from_metadata = set()
+        for j, column in enumerate(columns):
+            stats = row_group.column(j).statistics
+            # floats can hold NaN, which parquet does not count as null
+            if (
+                stats is not None
+                and stats.has_null_count
+                and stats.has_min_max
+                and not pa.types.is_floating(arrow_schema.field(column).type)
+            ):
+                from_metadata.add(column)
+                null_counts[column] += stats.null_count
+                minimums[column] = _min(minimums[column], stats.min)
+                maximums[column] = _max(maximums[column], stats.max)
+
+        # data is only needed for customers, NaN counts and distinct values
+        to_read = [
+            column
+            for column in columns
+            if column == "customer_ID"
+            or column not in from_metadata
+            or distinct[column] is not None
+        ]
+        # 8 bytes per value, as many columns at once as the budget holds
+        step = max(1, int(budget // max(row_group.num_rows * 8, 1)))
+        for start in range(0, len(to_read), step):
+            block = to_read[start : start + step]
+            table = parquet_file.read_row_group(i, columns=block)
+
+            for column in table.column_names:
+                values = table.column(column)
+                if column == "customer_ID" and len(values) > 0:
+                    # rows are sorted by customer, unique keeps their order.
+                    # The first customer may continue from the previous row group
+                    cids = pc.unique(values)
+                    n_customers += len(cids) - int(cids[0].as_py() == last_cid)
+                    last_cid = cids[-1].as_py()
+
+                if column in from_metadata and distinct[column] is None:
+                    continue
+                valid = pc.invert(pc.is_null(values, nan_is_null=True))
+                present = pc.filter(values, valid)
+
+                if column not in from_metadata:
+                    null_counts[column] += len(values) - len(present)
+                    if len(present) > 0:
+                        min_max = pc.min_max(present)
+                        low, high = min_max["min"].as_py(), min_max["max"].as_py()
+                        minimums[column] = _min(minimums[column], low)
+                        maximums[column] = _max(maximums[column], high)
+
+                if distinct[column] is not None:
+                    unique = pc.unique(present)
+                    if len(unique) > max_distinct:
+                        distinct[column] = None
+                    else:
+                        distinct[column].update(unique.to_pylist())
+                        if len(distinct[column]) > max_distinct:
+                            distinct[column] = None
+
+            del table
+
+    n_rows = metadata.num_rows
+    schema = {
+        "source": str(path),
+        "n_rows": n_rows,
+        "n_customers": n_customers,
+        "max_distinct": max_distinct,
+        "columns": {},
+    }
+    for column in columns:
+        few = distinct[column] is not None
+        schema["columns"][column] = {
+            "type": str(arrow_schema.field(column).type),
+            "non_null": n_rows - null_counts[column],
+            "null_fraction": null_counts[column] / max(n_rows, 1),
+            # None when the column has more than max_distinct values
+            "distinct": len(distinct[column]) if few else None,
+            "values": sorted(distinct[column]) if few else None,
+            "min": minimums[column],
+            "max": maximums[column],
+        }
+
+    print("Profiled columns:", len(columns), "customers:", n_customers)
+    return schema
+
+
+def select_columns(schema, thresh=0.6):
+    """
+    the column selection of the padded frame, from the profile alone: drops
+    columns with less than thresh non-null values over 13 statements per
+    customer and puts the columns with at most max_distinct values first,
+    ordered by number of values. Returns the ordered feature columns and the
+    sorted values (category codes) of the categorical ones.
+    """
+    profiles = schema["columns"]
+    min_count = int(thresh * schema["n_customers"] * 13)
+    # the first two columns are customer_ID and S_2
+    kept = [c for c in list(profiles)[2:] if profiles[c]["non_null"] >= min_count]
+
+    features = []
+    category_codes = {}
+    for nb_classes in range(1, schema["max_distinct"] + 1):
+        for column in kept:
+            if profiles[column]["distinct"] == nb_classes:
+                features.append(column)
+                category_codes[column] = np.asarray(profiles[column]["values"])
+    features.extend([column for column in kept if column not in category_codes])
+
+    return features, category_codes
+
+
+def save_schema(schema, path="schema.json"):
+    with open(path, "w") as file:
+        json.dump(schema, file, indent=4, default=str)
+
+
+def load_schema(path="schema.json"):
+    with open(path) as file:
+        return json.load(file)
@@ -0,0 +1,204 @@
+import atexit
+import fcntl
+import json
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import torch as t
+from torch.utils.data import Dataset
+
+"""
+one copy of the prepared training arrays per machine: the first process copies
+them into a named POSIX shared-memory segment (/dev/shm), DataLoader workers and
+other local training runs attach to it without copying. A registry next to the
+segment lists the pids using it; dead pids are pruned on every attach/release
+(workers exit without running atexit), and the last process to release the
+segment unlinks it and removes the registry and lock files. A process killed
+before it released leaves the segment in /dev/shm until the next attach.
+"""
+
+registry_dir = "/dev/shm"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+if sys.version_info >= (3, 13):
+
+    def _open(name, create=False, size=0):
+        # the lifetime is handled by the registry, not by python's resource
+        # tracker (which would unlink the segment when the first attached
+        # process exits)
+        return shared_memory.SharedMemory(name, create, size, track=False)
+
+    def _unlink(segment):
+        # the mapping stays valid for the tensors over it
+        segment.unlink()
+
+else:
+
+    def _open(name, create=False, size=0):
+        segment = shared_memory.SharedMemory(name, create, size)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+    def _unlink(segment):
+        # unlink() unregisters the segment from the resource tracker again
+        resource_tracker.register(segment._name, "shared_memory")
+        segment.unlink()
+
+
+class SharedTensors:
+    """
+    attaches to the segment named by key, creating it from sources (name ->
+    array) if no live process holds it. prepare, called by the creator only,
+    may modify the shared tensors in place (e.g. normalize) before they are
+    published. tensors maps the names to torch tensors over the segment.
+    """
+
+    def __init__(self, key, sources, prepare=None):
+        self.key = key
+        self.name = f"amex-{key}"
+        self.registry_file = os.path.join(registry_dir, self.name + ".json")
+        self.lock_file = os.path.join(registry_dir, self.name + ".lock")
+        self.segment = None
+        self.attach(sources, prepare)
+        atexit.register(self.release)
+
+    def _locked(self):
+        # the last release removes the lock file: a lock taken on the removed
+        # file is taken again on the new one
+        while True:
+            lock = open(self.lock_file, "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(self.lock_file).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _read_registry(self):
+        if not os.path.exists(self.registry_file):
+            return None
+        with open(self.registry_file) as file:
+            return json.load(file)
+
+    def _write_registry(self, registry):
+        tmp_file = self.registry_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(registry, file)
+        os.replace(tmp_file, self.registry_file)
+
+    def attach(self, sources=None, prepare=None):
+        with self._locked():
+            registry = self._read_registry()
+            if registry is not None:
+                registry["pids"] = [pid for pid in registry["pids"] if _pid_alive(pid)]
+                try:
+                    self.segment = _open(self.name)
+                except FileNotFoundError:
+                    registry = None
+            if registry is not None and len(registry["pids"]) == 0:
+                # left behind by processes that died without releasing it
+                _unlink(self.segment)
+                registry = None
+
+            if registry is None:
+                if sources is None:
+                    raise RuntimeError(f"shared memory {self.name} no longer exists")
+                registry = self._create(sources, prepare)
+
+            registry["pids"].append(os.getpid())
+            self._write_registry(registry)
+
+        self.arrays = registry["arrays"]
+        self.tensors = {
+            name: t.from_numpy(self._view(spec)) for name, spec in self.arrays.items()
+        }
+
+    def _view(self, spec):
+        dtype = np.dtype(spec["dtype"])
+        return np.ndarray(
+            spec["shape"], dtype, buffer=self.segment.buf, offset=spec["offset"]
+        )
+
+    def _create(self, sources, prepare, chunk_size=65536):
+        arrays = {}
+        size = 0
+        for name, values in sources.items():
+            values = np.asarray(values)
+            size = (size + 63) // 64 * 64  # aligned for vectorized access
+            arrays[name] = {
+                "offset": size,
+                "shape": list(values.shape),
+                "dtype": values.dtype.str,
+            }
+            size += values.nbytes
+
+        try:
+            self.segment = _open(self.name, True, max(size, 1))
+        except FileExistsError:
+            # a segment without registry, left by a crash during creation
+            _unlink(_open(self.name))
+            self.segment = _open(self.name, True, max(size, 1))
+        for name, values in sources.items():
+            target = self._view(arrays[name])
+            # copied chunk by chunk from the memory mapped store
+            for start in range(0, len(target), chunk_size):
+                target[start : start + chunk_size] = values[start : start + chunk_size]
+
+        if prepare is not None:
+            prepare([t.from_numpy(self._view(spec)) for spec in arrays.values()])
+
+        print("Created shared memory:", self.name, size / 1024**3, "GB")
+        return {"arrays": arrays, "pids": []}
+
+    def release(self):
+        if self.segment is None:
+            return
+        with self._locked():
+            registry = self._read_registry() or {"pids": []}
+            pids = [pid for pid in registry["pids"] if _pid_alive(pid)]
+            pids = [pid for pid in pids if pid != os.getpid()]
+            if len(pids) == 0:
+                _unlink(self.segment)
+                if os.path.exists(self.registry_file):
+                    os.remove(self.registry_file)
+                os.remove(self.lock_file)
+            else:
+                registry["pids"] = pids
+                self._write_registry(registry)
+        self.segment = None
+
+    def __getstate__(self):
+        # spawned workers re-attach by name instead of pickling the data
+        return {"key": self.key}
+
+    def __setstate__(self, state):
+        self.__init__(state["key"], sources=None)
+
+
+class SharedTensorDataset(Dataset):
+    """
+    TensorDataset over a SharedTensors segment; pickles as the segment key so
+    spawned workers attach to it rather than receiving a copy
+    """
+
+    def __init__(self, shared: SharedTensors, names):
+        self.shared = shared
+        self.names = names
+
+    def __len__(self):
+        return self.shared.tensors[self.names[0]].shape[0]
+
+    def __getitem__(self, idx):
+        return tuple(self.shared.tensors[name][idx] for name in self.names)
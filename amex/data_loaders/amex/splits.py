@@ -0,0 +1,39 @@
+import os
+import numpy as np
+
+"""
+train/test splits as index arrays, stratified on y and cached next to the
+tensor store, so every run and every model family evaluates on the same
+holdout and no split copies the data
+"""
+
+
+def split_indices(y, test_size=0.1, seed=1):
+    y = np.asarray(y)
+    rng = np.random.default_rng(seed)
+
+    train, test = [], []
+    for label in np.unique(y):
+        idx = rng.permutation(np.flatnonzero(y == label))
+        n_test = int(round(test_size * len(idx)))
+        test.append(idx[:n_test])
+        train.append(idx[n_test:])
+
+    # sorted, so that reading a subset walks the memory mapped store forward
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(test))
+
+
+def load_split(data_location, y, test_size=0.1, seed=1):
+    path = os.path.join(data_location, f"split_seed{seed}_test{test_size}.npz")
+    y = np.asarray(y)
+    positives = int((y == 1).sum())
+
+    if os.path.exists(path):
+        split = np.load(path)
+        # recomputed when the labels behind the cached split changed
+        if int(split["n"]) == len(y) and int(split["positives"]) == positives:
+            return split["train"], split["test"]
+
+    train, test = split_indices(y, test_size, seed)
+    np.savez(path, train=train, test=test, n=len(y), positives=positives)
+    return train, test
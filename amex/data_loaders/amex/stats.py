@@ -0,0 +1,123 @@
+import json
+import os
+import numpy as np
+import torch as t
+
+"""
+per feature statistics over the real (non-NaN) values: count, mean, variance,
+min and max, accumulated chunk by chunk with Chan's parallel form of Welford's
+update, so a store is summarized in one streaming pass. The result is saved in
+the tensor store directory, next to header.json.
+"""
+
+stats_file = "stats.json"
+
+
+class FeatureStats:
+    def __init__(self, n_features):
+        self.count = np.zeros(n_features, dtype=np.int64)
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+
+    def update(self, x, chunk_size=65536):
+        # x: (..., F) with NaN for missing values, e.g. a padded (N, 13, F) chunk
+        x = np.asarray(x).reshape(-1, self.count.shape[0])
+        for start in range(0, len(x), chunk_size * 13):
+            self._update(x[start : start + chunk_size * 13].astype(np.float64))
+
+    def _update(self, x):
+        valid = ~np.isnan(x)
+        count = valid.sum(0)
+        mean = np.where(valid, x, 0).sum(0) / np.maximum(count, 1)
+        m2 = np.square(np.where(valid, x - mean, 0)).sum(0)
+
+        self.min = np.minimum(self.min, np.where(valid, x, np.inf).min(0))
+        self.max = np.maximum(self.max, np.where(valid, x, -np.inf).max(0))
+        self.merge(count, mean, m2)
+
+    def merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        weight = count / np.maximum(total, 1)
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + m2 + np.square(delta) * self.count * weight
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+
+    def state_dict(self):
+        # features without any value keep min inf / max -inf, saved as null
+        finite = lambda a: [float(v) if np.isfinite(v) else None for v in a]
+        return {
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "min": finite(self.min),
+            "max": finite(self.max),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state):
+        stats = cls(len(state["count"]))
+        stats.count = np.asarray(state["count"], dtype=np.int64)
+        stats.mean = np.asarray(state["mean"])
+        stats.m2 = np.asarray(state["m2"])
+        none_to = lambda a, v: np.asarray([v if x is None else x for x in a], float)
+        stats.min = none_to(state["min"], np.inf)
+        stats.max = none_to(state["max"], -np.inf)
+        return stats
+
+
+def save_stats(store, stats, n_customers):
+    tmp_file = os.path.join(store, stats_file + ".tmp")
+    with open(tmp_file, "w") as file:
+        json.dump({"n_customers": int(n_customers), **stats.state_dict()}, file)
+    os.replace(tmp_file, os.path.join(store, stats_file))
+
+
+def load_stats(store, n_customers=None):
+    # None when the store has no statistics or they belong to other data
+    path = os.path.join(store, stats_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        state = json.load(file)
+    if n_customers is not None and state["n_customers"] != n_customers:
+        return None
+    return FeatureStats.from_state_dict(state)
+
+
+def normalizer(stats, normalization, n_categorical=11):
+    """
+    the in place normalization of the continuous features x[..., n_categorical:]
+    as (x - shift) / div + bias, or None for normalization "none". The same
+    function serves training and, with the training statistics, inference.
+    """
+    continuous = slice(n_categorical, None)
+    if normalization == "standard":
+        shift, div, bias = stats.mean[continuous], stats.std[continuous], 0
+    elif normalization in ("tanh", "sigmoid"):
+        shift = stats.min[continuous]
+        div = stats.max[continuous] - stats.min[continuous]
+        bias = 0
+        if normalization == "tanh":
+            div, bias = div / 2, -1
+    else:
+        return None
+
+    # constant and empty features are only shifted
+    div = np.where(np.isfinite(div) & (div > 0), div, 1)
+    shift = np.where(np.isfinite(shift), shift, 0)
+    shift = t.tensor(shift, dtype=t.float32)
+    div = t.tensor(div, dtype=t.float32)
+
+    def normalize(x):
+        # in place, on whichever device x is
+        values = x[..., continuous]
+        values.sub_(shift.to(x.device)).div_(div.to(x.device)).add_(bias)
+
+    return normalize
@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch as t
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from .tensor_store import load_header, open_array, x_arrays
+
+"""
+out-of-core training over a sharded store (see tensor_store.load_shards): only
+the shard being consumed, the next one (read by a background thread) and the
+shuffle buffer are held in memory, whatever the size of the store
+"""
+
+
+class ShardedDataset(IterableDataset):
+    """
+    yields whole batches (the x arrays of the layout and y, as the in-memory
+    loader does) of the customers selected by indices (global, over the
+    concatenated shards). Shards are dealt round robin to the DataLoader
+    workers, so no customer is read twice and every worker reads the same rows
+    in every epoch. With shuffle, the order of a worker's shards and the
+    shuffle buffer are drawn from (seed, epoch, worker): an epoch is
+    reproducible for a given seed and number of workers.
+    """
+
+    def __init__(
+        self,
+        shards,
+        indices,
+        batch_size,
+        shuffle=False,
+        shuffle_buffer=65536,
+        seed=0,
+    ):
+        self.shards = shards
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        # set by EpochDataLoader, the length depends on how shards are dealt
+        self.num_workers = 1
+
+        header = load_header(shards[0][0])
+        if header.get("layout", "dense") == "ragged":
+            raise ValueError("streaming needs a dense or compact store")
+        self.names = x_arrays(header) + ["y"]
+
+        self.selected = np.zeros(shards[-1][2], dtype=bool)
+        self.selected[np.asarray(indices)] = True
+        # selected customers of every shard, from the ranges of shards.json
+        self.shard_rows = np.array(
+            [self.selected[start:stop].sum() for _, start, stop in shards]
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # batches per epoch: without shuffle every shard ends with a partial
+        # batch, with shuffle only the last batch of every worker is partial
+        n_batches = 0
+        for worker_id in range(self.num_workers):
+            rows = self.shard_rows[worker_id :: self.num_workers]
+            if self.shuffle:
+                rows = rows.sum()
+            n_batches += int(np.sum(-(-rows // self.batch_size)))
+        return n_batches
+
+    def load_shard(self, shard):
+        path, start, stop = self.shards[shard]
+        header = load_header(path)
+        selected = self.selected[start:stop]
+        # boolean indexing reads the memory mapped rows into memory
+        return [open_array(path, name, header)[selected] for name in self.names]
+
+    def worker_shards(self):
+        worker = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker is not None:
+            worker_id, num_workers = worker.id, worker.num_workers
+
+        # shuffles this worker's shards and then its buffer
+        rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+        shards = np.arange(len(self.shards))[worker_id::num_workers]
+        if self.shuffle:
+            shards = rng.permutation(shards)
+        return shards, rng
+
+    def batches(self, arrays):
+        for start in range(0, len(arrays[0]), self.batch_size):
+            yield [t.from_numpy(a[start : start + self.batch_size]) for a in arrays]
+
+    def __iter__(self):
+        shards, rng = self.worker_shards()
+
+        buffer = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_shard = None
+            if len(shards) > 0:
+                next_shard = executor.submit(self.load_shard, shards[0])
+            for i in range(len(shards)):
+                arrays = next_shard.result()
+                if i + 1 < len(shards):
+                    # read ahead while this shard is shuffled and consumed
+                    next_shard = executor.submit(self.load_shard, shards[i + 1])
+
+                if not self.shuffle:
+                    yield from self.batches(arrays)
+                    continue
+
+                if buffer is not None:
+                    arrays = [np.concatenate([b, a]) for b, a in zip(buffer, arrays)]
+                order = rng.permutation(len(arrays[0]))
+                arrays = [a[order] for a in arrays]
+
+                # whole batches are taken from the shuffled buffer as long as
+                # more than shuffle_buffer samples remain
+                n_out = max(len(order) - self.shuffle_buffer, 0)
+                n_out -= n_out % self.batch_size
+                yield from self.batches([a[:n_out] for a in arrays])
+                buffer = [a[n_out:] for a in arrays]
+
+        if buffer is not None:
+            yield from self.batches(buffer)
+
+
+class EpochDataLoader(DataLoader):
+    """
+    DataLoader over a ShardedDataset that moves the dataset to the next epoch
+    each time it is iterated, before the workers receive their copy of it
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.epoch = 0
+        self.dataset.num_workers = max(self.num_workers, 1)
+
+    def __iter__(self):
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        return super().__iter__()
@@ -0,0 +1,151 @@
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+"""
+synthetic data with the schema of the Amex parquet files, to run and benchmark
+the preprocessing without the Kaggle data: a 64 character hexadecimal
+customer_ID, S_2 statement dates, 1 to 13 statements per customer (most have
+13), 188 features named like the real ones, 11 of them categorical (D_63 and
+D_64 as strings), NaN rates such that the preprocessing keeps 157 features as
+on the real data, rows sorted by customer and date, and a matching labels csv.
+
+    python -m amex.data_loaders.amex.synthetic --customers 100000
+"""
+
+categorical = {
+    "B_30": [0.0, 1.0, 2.0],
+    "B_38": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0],
+    "D_114": [0.0, 1.0],
+    "D_116": [0.0, 1.0],
+    "D_117": [-1.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+    "D_120": [0.0, 1.0],
+    "D_126": [-1.0, 0.0, 1.0],
+    "D_63": ["CL", "CO", "CR", "XL", "XM", "XZ"],
+    "D_64": ["-1", "O", "R", "U"],
+    "D_66": [0.0, 1.0],
+    "D_68": [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+}
+
+# columns the selection keeps at thresh 0.6, as on the real data
+n_kept = 157
+
+# number of features per prefix (delinquency, spend, payment, balance, risk)
+prefixes = {"D": 96, "S": 21, "P": 3, "B": 40, "R": 28}
+
+
+def feature_columns():
+    columns = list(categorical)
+    for prefix, count in prefixes.items():
+        number = 1
+        while sum(column.startswith(prefix + "_") for column in columns) < count:
+            name = f"{prefix}_{number}"
+            # S_2 is the statement date
+            if name not in columns and name != "S_2":
+                columns.append(name)
+            number += 1
+    return sorted(columns, key=lambda c: (c[0], int(c.split("_")[1])))
+
+
+def nan_rates(columns, rng):
+    """
+    the categorical columns and n_kept - 11 others are almost complete, the
+    remaining ones mostly missing: with 12 statements per customer on average,
+    select_columns keeps exactly n_kept columns at its default thresh of 0.6,
+    the 11 categoricals first, like on the real data
+    """
+    continuous = [column for column in columns if column not in categorical]
+    dropped = set(rng.choice(continuous, len(columns) - n_kept, replace=False))
+    n = len(columns)
+    # kept: at most 20% missing, dropped: at least 70%
+    kind = rng.choice(2, size=n, p=[0.8, 0.2])
+    low = np.choose(kind, [rng.uniform(0, 0.05, n), rng.uniform(0.05, 0.2, n)])
+    high = rng.uniform(0.7, 0.999, n)
+    rates = np.where([column in dropped for column in columns], high, low)
+    return dict(zip(columns, rates))
+
+
+def customer_ids(n_customers, rng):
+    # random 32 byte keys as 64 hexadecimal characters, sorted like the files
+    keys = rng.bytes(32 * n_customers)
+    return np.sort([keys[i : i + 32].hex() for i in range(0, len(keys), 32)])
+
+
+def customer_chunk(cids, columns, rates, rng):
+    n_customers = len(cids)
+    statements = np.where(
+        rng.random(n_customers) < 0.85, 13, rng.integers(1, 13, n_customers)
+    )
+    n_rows = int(statements.sum())
+    customer = np.repeat(np.arange(n_customers), statements)
+    starts = np.repeat(np.cumsum(statements) - statements, statements)
+    slot = np.arange(n_rows) - starts
+
+    # monthly statements up to March 2018, a few days of jitter
+    months_back = np.repeat(statements, statements) - 1 - slot
+    dates = np.datetime64("2018-03-31") - months_back * np.timedelta64(30, "D")
+    dates = dates - rng.integers(0, 5, n_rows).astype("timedelta64[D]")
+
+    data = {"customer_ID": cids[customer], "S_2": np.datetime_as_string(dates)}
+    for column in columns:
+        missing = rng.random(n_rows) < rates[column]
+        if column in categorical:
+            values = np.asarray(categorical[column])[
+                rng.integers(0, len(categorical[column]), n_rows)
+            ]
+            if values.dtype.kind == "U":
+                values = values.astype(object)
+                values[missing] = None
+            else:
+                values = values.astype(np.float32)
+                values[missing] = np.nan
+        else:
+            values = rng.gamma(1.0, 0.3, n_rows).astype(np.float32)
+            values[missing] = np.nan
+        data[column] = values
+    return pd.DataFrame(data)
+
+
+def generate(
+    path="train_data.parquet",
+    labels_path="train_labels.csv",
+    n_customers=10000,
+    seed=0,
+    chunk_customers=20000,
+    positive_rate=0.26,
+):
+    rng = np.random.default_rng(seed)
+    columns = feature_columns()
+    rates = nan_rates(columns, rng)
+    all_cids = customer_ids(n_customers, rng)
+
+    writer = None
+    labels = []
+    for first in range(0, n_customers, chunk_customers):
+        cids = all_cids[first : first + chunk_customers]
+        df = customer_chunk(cids, columns, rates, rng)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table, row_group_size=100000)
+
+        target = (rng.random(len(cids)) < positive_rate).astype(int)
+        labels.append(pd.DataFrame({"customer_ID": cids, "target": target}))
+    writer.close()
+
+    if labels_path is not None:
+        pd.concat(labels, ignore_index=True).to_csv(labels_path, index=False)
+    print("Generated customers:", n_customers, "columns:", len(columns) + 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--customers", type=int, default=10000)
+    parser.add_argument("--output", default="train_data.parquet")
+    parser.add_argument("--labels", default="train_labels.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.output, args.labels, args.customers, args.seed)
@@ -0,0 +1,379 @@
+import json
+import os
+import shutil
+import numpy as np
+import torch as t
+
+from .compression import compress_rows, read_compressed_rows
+from .stats import stats_file
+
+"""
+raw binary tensor store: a directory holding one raw file per array and a small
+JSON header with the shape and dtype of every array and the feature column
+order. Arrays are opened with np.memmap, so opening a store reads no data and
+concurrent processes share its pages through the OS page cache.
+"""
+
+header_file = "header.json"
+shards_file = "shards.json"
+
+"""
+layouts of x:
+  dense: "x" float32 (N, 13, F), NaN for missing values
+  compact: "categorical" uint8 (N, 13, n_categorical), the integer codes of the
+    categorical columns (the first n_categorical ones, the number of category
+    codes preprocessing fits, recorded in the header), "continuous" float16 or
+    bfloat16 (stored as int16 bits) (N, 13, F - n_categorical) and "mask", the
+    missing values bit-packed along the features (N, 13, ceil(F / 8)). It is
+    expanded back to the dense float32 layout per batch by expand_compact.
+  ragged: only the real statements, CSR style: "statements" float32
+    (total statements, F), "offsets" int64 (N + 1,) where customer i owns rows
+    offsets[i]:offsets[i + 1], and "lengths" uint8 (N,). Batches are padded to
+    13 statements by pad_statements only when a model needs the dense shape.
+"""
+layout_arrays = {
+    "dense": ["x"],
+    "compact": ["categorical", "continuous", "mask"],
+    "ragged": ["statements", "offsets", "lengths"],
+}
+
+
+class TensorStoreWriter:
+    """
+    writes the arrays of a store chunk by chunk: create() declares the full
+    shape, append() adds rows along the first dimension. The header is written
+    last by close(), so a store with a header is always complete. With a codec
+    (see compression.available_codecs) every chunk_rows rows are compressed
+    separately, which keeps random access to customer ranges.
+    """
+
+    def __init__(self, path, columns=None, codec=None, chunk_rows=4096, **metadata):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.codec = codec
+        self.chunk_rows = chunk_rows
+        columns = [] if columns is None else list(columns)
+        self.header = {"columns": columns, "arrays": {}}
+        self.header.update(metadata)
+        self.files = {}
+        self.rows = {}
+
+    def create(self, name, shape, dtype):
+        self.header["arrays"][name] = {
+            "file": f"{name}.bin",
+            "shape": [int(size) for size in shape],
+            "dtype": np.dtype(dtype).str,
+        }
+        if self.codec is not None:
+            # [first row, rows, byte offset, byte size] of every chunk
+            self.header["arrays"][name].update(codec=self.codec, chunks=[])
+        self.files[name] = open(os.path.join(self.path, f"{name}.bin"), "wb")
+        self.rows[name] = 0
+
+    def append(self, name, values):
+        spec = self.header["arrays"][name]
+        values = np.ascontiguousarray(values, dtype=np.dtype(spec["dtype"]))
+        if list(values.shape[1:]) != spec["shape"][1:]:
+            raise ValueError(f"{name}: rows of shape {values.shape[1:]} do not fit")
+
+        if self.codec is None:
+            self.files[name].write(values.tobytes())
+        else:
+            first_row = self.rows[name]
+            chunks = compress_rows(values, self.codec, chunk_rows=self.chunk_rows)
+            for n_rows, blob in chunks:
+                offset = self.files[name].tell()
+                self.files[name].write(blob)
+                spec["chunks"].append([first_row, n_rows, offset, len(blob)])
+                first_row += n_rows
+        self.rows[name] += values.shape[0]
+
+    def write(self, name, values):
+        values = np.asarray(values)
+        self.create(name, values.shape, values.dtype)
+        self.append(name, values)
+
+    def create_x(
+        self,
+        shape,
+        layout="dense",
+        n_categorical=None,
+        continuous_dtype="float16",
+        n_statements=None,
+    ):
+        # n_categorical: the number of categorical columns, needed by compact
+        self.header["layout"] = layout
+        if n_categorical is not None:
+            self.header["n_categorical"] = int(n_categorical)
+        if layout == "dense":
+            self.create("x", shape, np.float32)
+        elif layout == "ragged":
+            # n_statements: number of real statements, i.e. of parquet rows
+            n, steps, features = shape
+            self.header["max_statements"] = steps
+            self.create("statements", (n_statements, features), np.float32)
+            self.create("offsets", (n + 1,), np.int64)
+            self.create("lengths", (n,), np.uint8)
+            self.append("offsets", np.zeros(1, dtype=np.int64))
+        elif layout == "compact":
+            if n_categorical is None:
+                raise ValueError("the compact layout needs n_categorical")
+            n, steps, features = shape
+            self.header["n_features"] = features
+            self.header["continuous_dtype"] = continuous_dtype
+            continuous = np.float16 if continuous_dtype == "float16" else np.int16
+            self.create("categorical", (n, steps, n_categorical), np.uint8)
+            self.create("continuous", (n, steps, features - n_categorical), continuous)
+            self.create("mask", (n, steps, (features + 7) // 8), np.uint8)
+        else:
+            raise ValueError(f"Unknown layout {layout}")
+
+    def append_x(self, x, lengths=None):
+        # lengths: real statements per customer, needed by the ragged layout
+        if self.header["layout"] == "dense":
+            self.append("x", x)
+            return
+
+        if self.header["layout"] == "ragged":
+            real = np.arange(x.shape[1]) < lengths[:, None]
+            start = self.rows["statements"]
+            self.append("statements", x[real])
+            self.append("offsets", start + np.cumsum(lengths))
+            self.append("lengths", lengths)
+            return
+
+        arrays = compact_arrays(
+            x, self.header["n_categorical"], self.header["continuous_dtype"]
+        )
+        for name, values in arrays.items():
+            self.append(name, values)
+
+    def close(self):
+        for name, file in self.files.items():
+            file.close()
+            if self.rows[name] != self.header["arrays"][name]["shape"][0]:
+                raise ValueError(f"{name}: {self.rows[name]} rows written")
+
+        tmp_file = os.path.join(self.path, header_file + ".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(self.header, file, indent=4)
+        os.replace(tmp_file, os.path.join(self.path, header_file))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for file in self.files.values():
+                file.close()
+
+
+def is_tensor_store(path):
+    return os.path.exists(os.path.join(path, header_file))
+
+
+def load_header(path):
+    with open(os.path.join(path, header_file)) as file:
+        return json.load(file)
+
+
+def open_array(path, name, header=None, mode="c"):
+    # mode "c" is copy-on-write: reads come from the shared page cache, writes
+    # (e.g. in place normalization) stay private to the process
+    header = load_header(path) if header is None else header
+    spec = header["arrays"][name]
+    if "codec" in spec:
+        # compressed arrays are decompressed into memory, in parallel
+        return read_compressed_rows(os.path.join(path, spec["file"]), spec)
+    shape = tuple(spec["shape"])
+    dtype = np.dtype(spec["dtype"])
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(os.path.join(path, spec["file"]), dtype, mode, shape=shape)
+
+
+def x_arrays(header):
+    return layout_arrays[header.get("layout", "dense")]
+
+
+def load_tensor_store(path, names=("x", "y")):
+    header = load_header(path)
+    return [t.from_numpy(open_array(path, name, header)) for name in names]
+
+
+def save_tensor_store(
+    path,
+    x,
+    y,
+    columns=None,
+    layout="dense",
+    continuous_dtype="float16",
+    lengths=None,
+    codec=None,
+    n_categorical=None,
+    customer_ids=None,
+    **metadata,
+):
+    # customer_ids: the sorted keys of the rows, see customer_index
+    if layout == "ragged" and lengths is None:
+        # real statements come first, padding rows are all NaN
+        lengths = (~np.isnan(x).all(axis=2)).sum(axis=1)
+    n_statements = None if lengths is None else int(lengths.sum())
+
+    with TensorStoreWriter(path, columns, codec, **metadata) as writer:
+        writer.create_x(
+            x.shape,
+            layout,
+            n_categorical,
+            continuous_dtype=continuous_dtype,
+            n_statements=n_statements,
+        )
+        writer.append_x(x, lengths)
+        writer.write("y", np.asarray(y, dtype=np.float32))
+        if customer_ids is not None:
+            writer.write("customer_ID", customer_ids)
+
+
+def compact_arrays(x, n_categorical, continuous_dtype="float16"):
+    missing = np.isnan(x)
+
+    categorical = np.nan_to_num(x[..., :n_categorical], nan=0)
+    if (categorical != np.round(categorical)).any():
+        raise ValueError("categorical columns hold non-integer values")
+    if categorical.size > 0 and (categorical.min() < 0 or categorical.max() > 255):
+        raise ValueError("categorical codes do not fit in uint8")
+
+    continuous = np.nan_to_num(x[..., n_categorical:], nan=0).astype(np.float32)
+    if continuous_dtype == "float16":
+        if continuous.size > 0 and np.abs(continuous).max() > np.finfo(np.float16).max:
+            raise ValueError("continuous values overflow float16, use bfloat16")
+        continuous = continuous.astype(np.float16)
+    else:
+        # bfloat16 is the upper half of float32, rounded to nearest even
+        bits = continuous.view(np.uint32)
+        bits = bits + np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+        continuous = (bits >> 16).astype(np.uint16).view(np.int16)
+
+    return {
+        "categorical": categorical.astype(np.uint8),
+        "continuous": continuous,
+        "mask": np.packbits(missing, axis=-1),
+    }
+
+
+def expand_compact(categorical, continuous, mask, continuous_dtype="float16"):
+    # runs on whichever device the batch is on, e.g. after the host to device copy
+    if continuous_dtype == "bfloat16":
+        continuous = continuous.view(t.bfloat16)
+    x = t.cat([categorical.float(), continuous.float()], dim=-1)
+
+    # np.packbits order: the first feature is the most significant bit
+    shifts = t.arange(7, -1, -1, dtype=t.uint8, device=mask.device)
+    missing = (mask.unsqueeze(-1) >> shifts) & 1
+    missing = missing.flatten(-2)[..., : x.shape[-1]].bool()
+    return x.masked_fill(missing, float("nan"))
+
+
+def pad_statements(statements, lengths, max_statements=13):
+    # scatters the statements of a ragged batch into a NaN padded dense batch
+    x = statements.new_full((len(lengths), max_statements, statements.shape[-1]), np.nan)
+    real = t.arange(max_statements, device=lengths.device) < lengths[:, None].long()
+    x[real] = statements
+    return x
+
+
+def read_customers(header, tensors, start, stop):
+    # the x arrays of customers start:stop, as a batch for expand_x
+    if header.get("layout", "dense") == "ragged":
+        statements, offsets, lengths = tensors
+        return [statements[offsets[start] : offsets[stop]], lengths[start:stop]]
+    return [tensor[start:stop] for tensor in tensors]
+
+
+def expand_x(header, tensors):
+    # tensors: a batch of the x arrays (ragged: statements and lengths),
+    # returns float32 x of shape (B, 13, F) with NaN for missing values
+    layout = header.get("layout", "dense")
+    if layout == "dense":
+        return tensors[0]
+    if layout == "ragged":
+        return pad_statements(*tensors, header["max_statements"])
+    return expand_compact(*tensors, header["continuous_dtype"])
+
+
+"""
+sharded store: a directory of tensor stores shard-00000, shard-00001, ... of
+consecutive customers, indexed by shards.json (written last, like the header of
+a single store) with the number of customers of every shard
+"""
+
+
+def shard_path(path, shard):
+    return os.path.join(path, f"shard-{shard:05d}")
+
+
+def save_shards_index(path, sizes, **metadata):
+    shards = [
+        {"path": os.path.basename(shard_path(path, shard)), "n_customers": int(size)}
+        for shard, size in enumerate(sizes)
+    ]
+    os.makedirs(path, exist_ok=True)
+    tmp_file = os.path.join(path, shards_file + ".tmp")
+    with open(tmp_file, "w") as file:
+        json.dump({"shards": shards, **metadata}, file, indent=4)
+    os.replace(tmp_file, os.path.join(path, shards_file))
+
+
+def is_sharded_store(path):
+    return os.path.exists(os.path.join(path, shards_file))
+
+
+def load_shards(path):
+    # (path, first customer, last customer + 1) of every shard
+    with open(os.path.join(path, shards_file)) as file:
+        index = json.load(file)
+    shards, start = [], 0
+    for shard in index["shards"]:
+        stop = start + shard["n_customers"]
+        shards.append((os.path.join(path, shard["path"]), start, stop))
+        start = stop
+    return shards
+
+
+def read_rows(path, name, start, stop, header=None):
+    # rows start:stop of one array, only reading (and decompressing) those rows
+    header = load_header(path) if header is None else header
+    spec = header["arrays"][name]
+    if "codec" in spec:
+        return read_compressed_rows(os.path.join(path, spec["file"]), spec, start, stop)
+    return np.array(open_array(path, name, header)[start:stop])
+
+
+def compress_store(path, target, codec, chunk_rows=4096, chunk_size=65536):
+    # copy of a store with every array compressed, chunk_size rows at a time
+    header = load_header(path)
+    metadata = {k: v for k, v in header.items() if k not in ("columns", "arrays")}
+    with TensorStoreWriter(
+        target, header["columns"], codec, chunk_rows, **metadata
+    ) as writer:
+        for name, spec in header["arrays"].items():
+            writer.create(name, spec["shape"], spec["dtype"])
+            for start in range(0, spec["shape"][0], chunk_size):
+                rows = read_rows(path, name, start, start + chunk_size, header)
+                writer.append(name, rows)
+    # the normalization statistics do not depend on the encoding
+    if os.path.exists(os.path.join(path, stats_file)):
+        shutil.copy(os.path.join(path, stats_file), target)
+
+
+def convert_tensor_pt(
+    pt_file, path, columns=None, layout="dense", codec=None, n_categorical=None
+):
+    # one-off conversion of a pickled {"x", "y"} tensor.pt
+    tensor_dict = t.load(pt_file)
+    x, y = tensor_dict["x"].numpy(), tensor_dict["y"].numpy()
+    save_tensor_store(
+        path, x, y, columns, layout, codec=codec, n_categorical=n_categorical
+    )
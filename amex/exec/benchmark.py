@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import torch as t
+
+from amex.data_loaders.amex import synthetic
+from amex.data_loaders.amex.compression import available_codecs
+from amex.data_loaders.amex.memory import PeakRSS
+from amex.data_loaders.amex.pipeline import encode_stage, profile_stage, store_stage
+from amex.data_loaders.amex.preprocess import memory_budget
+from amex.data_loaders.amex.tensor_store import (
+    compress_store,
+    is_sharded_store,
+    load_header,
+    load_shards,
+    open_array,
+)
+
+"""
+benchmarks of the data pipeline, run from the data directory with the
+repository on PYTHONPATH:
+
+    python -m amex.exec.benchmark compression --store tensor_store
+    python -m amex.exec.benchmark preprocess --customers 10000,100000,1000000
+
+compression: size and decode throughput (GB/s of decoded arrays, best of
+--repeats, files in the page cache) of the store compressed with every available
+codec, against the torch.save output of the same arrays (what save_tensor used
+to write). Every decoded array is checked against the uncompressed store.
+
+preprocess: wall time, peak RSS and output size of every preprocessing stage
+(generate, profile, encode, store, load) on synthetic data of each --customers
+size, generated in a temporary directory. Peak RSS is sampled from /proc while
+the stage runs, so it is the peak of that stage and not of the process so far.
+"""
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def best_time(load, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        load()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def load_arrays(path):
+    header = load_header(path)
+    return {name: open_array(path, name, header) for name in header["arrays"]}
+
+
+def same_arrays(arrays, expected):
+    # NaN compares equal in float arrays
+    return all(
+        np.array_equal(arrays[name], values, equal_nan=values.dtype.kind == "f")
+        for name, values in expected.items()
+    )
+
+
+def benchmark_compression(store, chunk_rows=4096, repeats=3):
+    source = {name: np.array(values) for name, values in load_arrays(store).items()}
+    raw_bytes = sum(values.nbytes for values in source.values())
+    print("Store:", store, "arrays:", list(source), raw_bytes / 1024**3, "GB")
+
+    rows = []
+    # next to the store, on the same disk
+    tmp_dir = os.path.dirname(os.path.abspath(store))
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        pt_file = os.path.join(tmp, "tensor.pt")
+        t.save({name: t.from_numpy(values) for name, values in source.items()}, pt_file)
+        seconds = best_time(lambda: t.load(pt_file), repeats)
+        rows.append(("torch.save", directory_size(pt_file), seconds, True))
+
+        for codec in available_codecs():
+            target = os.path.join(tmp, codec)
+            start = time.perf_counter()
+            compress_store(store, target, codec, chunk_rows)
+            print(codec, "compressed in", round(time.perf_counter() - start, 2), "s")
+
+            seconds = best_time(lambda: load_arrays(target), repeats)
+            exact = same_arrays(load_arrays(target), source)
+            rows.append((codec, directory_size(target), seconds, exact))
+
+    pt_size = rows[0][1]
+    print(
+        f"{'format':<12}{'GB':>10}{'ratio':>10}{'vs .pt':>10}"
+        f"{'decode GB/s':>14}{'exact':>8}"
+    )
+    for name, size, seconds, exact in rows:
+        print(
+            f"{name:<12}{size / 1024**3:>10.3f}{raw_bytes / size:>10.2f}"
+            f"{pt_size / size:>10.2f}{raw_bytes / 1024**3 / seconds:>14.2f}"
+            f"{str(exact):>8}"
+        )
+    return rows
+
+
+def read_store(store):
+    # one pass over every array of the store, as training would read it
+    if is_sharded_store(store):
+        paths = [path for path, _, _ in load_shards(store)]
+    else:
+        paths = [store]
+    total = 0
+    for path in paths:
+        for values in load_arrays(path).values():
+            total += np.asarray(values).nbytes
+    return total
+
+
+def benchmark_preprocess(
+    sizes,
+    layout="dense",
+    shards=False,
+    codec=None,
+    budget=memory_budget,
+    tmp_dir=None,
+    output=None,
+):
+    rows = []
+    for n_customers in sizes:
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+            data = os.path.join(tmp, "train_data.parquet")
+            labels = os.path.join(tmp, "train_labels.csv")
+            profile = os.path.join(tmp, "profile")
+            encode = os.path.join(tmp, "encode")
+            store = os.path.join(tmp, "store")
+            for path in (profile, encode, store):
+                os.makedirs(path)
+
+            stages = [
+                ("generate", data, synthetic.generate, (data, labels, n_customers)),
+                ("profile", profile, profile_stage, (profile, data, 12, budget)),
+                ("encode", encode, encode_stage, (encode, data, profile, 0.6, budget)),
+                (
+                    "store",
+                    store,
+                    store_stage,
+                    (store, encode, labels, layout, "float16", shards, codec, budget),
+                ),
+                ("load", None, read_store, (store,)),
+            ]
+            for name, path, function, inputs in stages:
+                start = time.perf_counter()
+                with PeakRSS() as rss:
+                    function(*inputs)
+                seconds = time.perf_counter() - start
+                size = directory_size(path) if path is not None else 0
+                rows.append(
+                    {
+                        "customers": n_customers,
+                        "stage": name,
+                        "seconds": seconds,
+                        "peak_rss": rss.peak,
+                        "size": size,
+                    }
+                )
+                print(n_customers, "customers,", name, "in", round(seconds, 2), "s")
+
+    print(
+        f"{'customers':>10}{'stage':>10}{'seconds':>10}"
+        f"{'peak GB':>12}{'size GB':>10}"
+    )
+    for row in rows:
+        print(
+            f"{row['customers']:>10}{row['stage']:>10}{row['seconds']:>10.2f}"
+            f"{row['peak_rss'] / 1024**3:>12.3f}{row['size'] / 1024**3:>10.3f}"
+        )
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(rows, file, indent=4)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    compression = subparsers.add_parser("compression")
+    compression.add_argument("--store", default="tensor_store")
+    compression.add_argument("--chunk-rows", type=int, default=4096)
+    compression.add_argument("--repeats", type=int, default=3)
+
+    preprocessing = subparsers.add_parser("preprocess")
+    preprocessing.add_argument("--customers", default="10000,100000,1000000")
+    preprocessing.add_argument(
+        "--layout", choices=["dense", "compact", "ragged"], default="dense"
+    )
+    preprocessing.add_argument("--shards", action="store_true")
+    preprocessing.add_argument("--codec", choices=["zstd", "lz4", "zlib"])
+    preprocessing.add_argument(
+        "--memory-budget", type=float, default=memory_budget / 1024**3
+    )
+    preprocessing.add_argument("--tmp-dir", default=None)
+    preprocessing.add_argument("--output", default=None)
+
+    args = parser.parse_args()
+    if args.benchmark == "compression":
+        benchmark_compression(args.store, args.chunk_rows, args.repeats)
+    elif args.benchmark == "preprocess":
+        benchmark_preprocess(
+            [int(size) for size in args.customers.split(",")],
+            args.layout,
+            args.shards,
+            args.codec,
+            args.memory_budget * 1024**3,
+            args.tmp_dir,
+            args.output,
+        )
@@ -0,0 +1,443 @@
+import argparse
+import importlib
+import json
+import os
+import time
+from types import SimpleNamespace
+import torch as t
+from torch import nn
+
+from amex.models.transformer.modules.transformer import GaussianNoise
+
+"""
+benchmarks of the model building blocks, each checked against the
+implementation it replaces, run with the repository on PYTHONPATH:
+
+    python -m amex.exec.benchmark_models embedding --batch-sizes 8,32,128,256
+    python -m amex.exec.benchmark_models attention --backend sdpa
+    python -m amex.exec.benchmark_models tokens --batch-sizes 64,256
+    python -m amex.exec.benchmark_models axial --batch-sizes 8,32
+
+embedding: forward time of the fused TabularEmbedding of every model family
+against the former per feature module (BaselineEmbedding), on (B, 13, 157)
+batches with NaN values. The fused module loads the state dict of the former
+one through its checkpoint hook and the outputs are compared in eval mode (no
+noise), which checks the weight layout as well as the forward pass.
+
+attention: forward and backward time and activation memory (the bytes autograd
+saves for the backward pass) of SelfAttention with the given backend against
+the bmm one, with the same weights, on (B, 13, 157) inputs and 16 heads as in
+the transformer models (--split-heads: heads of embedding_dim / heads rounded
+up, e.g. 10 wide for the default 157 and 16 heads).
+
+tokens: parameters, training step time (forward and backward) and activation
+memory of the transformer classifier with a token per statement (Transformer)
+and with a token per statement and feature (FeatureTokenTransformer). The first
+always has 16 heads and depth 6, --num-heads, --depth and --token-dim set the
+second.
+
+axial: training throughput (customers per second, forward and backward) of the
+AxialClassifier with the hparams of amex.json, with its native axial blocks and,
+when the axial_attention package is installed, with the AxialAttention layers
+they replace (the two do not share weights, only their speed is compared).
+"""
+
+axial_hyperparameters = os.path.join(
+    os.path.dirname(__file__), "..", "models", "axial", "hyperparameters", "amex.json"
+)
+
+families = {
+    "transformer": "amex.models.transformer.modules.transformer",
+    "axial": "amex.models.axial.modules.axial",
+    "c_emb": "amex.models.c_emb.modules.transformer",
+    "emb_2d": "amex.models.emb_2d.modules.transformer",
+    "gan": "amex.models.gan.modules.transformer",
+    "conv1d": "amex.models.conv1d.modules.conv1d.transformer",
+}
+
+
+class Params(SimpleNamespace):
+    # the part of the mate params the modules read
+    def contains(self, name):
+        return hasattr(self, name)
+
+
+def model_params(**hparams):
+    return Params(hparams=Params(**hparams))
+
+
+def cuda_time(function, repeats, warmup=3):
+    # median seconds per call, synchronized on cuda
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        if t.cuda.is_available():
+            t.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        if t.cuda.is_available():
+            t.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def random_statements(embedding, batch_size, device, nan_rate=0.3, seed=0):
+    # (B, 13, 157): category codes first, then continuous values, some NaN
+    generator = t.Generator().manual_seed(seed)
+    shape = (batch_size, 13)
+    categorical = [
+        t.randint(0, n, shape, generator=generator).float()
+        for n in embedding.categories
+    ]
+    continuous = t.randn(shape + (embedding.n_continuous,), generator=generator)
+    x = t.cat([t.stack(categorical, dim=-1), continuous], dim=-1)
+    x[t.rand(x.shape, generator=generator) < nan_rate] = t.nan
+    return x.to(device)
+
+
+"""
+the per feature TabularEmbedding the fused one replaced, the former code of
+every family with only what differed between the copies as arguments: full
+(feature_embed_dim wide embeddings, GELU and a positional embedding) or flat
+(width 1 repeated over feature_embed_dim, LeakyReLU), the std of the noise of
+the continuous features, a bare nn.Linear(1, h) instead of nn.Sequential(noise,
+nn.Linear(1, h)), and a (B, T, D, h) output
+"""
+
+baselines = {
+    "transformer": dict(full=True, noise=0.01),
+    "axial": dict(full=True, noise=0.001, tokens=True),
+    "c_emb": dict(full=False, noise=None),
+    "emb_2d": dict(full=False, noise=None, bare_linear=True),
+    "gan": dict(full=True, noise=0.01),
+    "conv1d": dict(full=False, noise=0.01),
+}
+
+
+class BaselineEmbedding(nn.Module):
+    def __init__(self, params, full=True, noise=0.01, bare_linear=False, tokens=False):
+        super().__init__()
+        self.h_embedding_dim = params.hparams.feature_embed_dim
+        h_embedding = self.h_embedding_dim if full else 1
+        self.full = full
+        self.tokens = tokens
+
+        in_features = 157
+        categories = [2, 2, 2, 2, 3, 3, 4, 6, 7, 7, 7]
+        embeddings = [nn.Embedding(n, h_embedding) for n in categories]
+        for _ in range(len(categories), in_features):
+            if bare_linear:
+                embeddings.append(nn.Linear(1, h_embedding))
+                continue
+            layers = [] if noise is None else [GaussianNoise(noise)]
+            if h_embedding > 1:
+                layers.append(nn.Linear(1, h_embedding))
+            embeddings.append(nn.Sequential(*layers))
+        self.embeddings = nn.ModuleList(embeddings)
+
+        self.na_embedding = nn.Embedding(1, h_embedding)
+
+        self.act = nn.GELU() if full else nn.LeakyReLU(0.2)
+
+        if full:
+            self.pos_emb = nn.Embedding(params.hparams.in_features, h_embedding)
+
+    def embed_feature(self, x: t.Tensor, feature: int):
+        (B,) = x.size()
+
+        # find nans over batch
+        nan_mask = t.isnan(x)
+        nan_count = nan_mask.sum()
+
+        output = t.zeros(B, self.h_embedding_dim, device=x.device)
+        if nan_count > 0:
+            # if there are nans, we need to replace them nan embeddings
+            nan_embedding = self.na_embedding(t.zeros(nan_count, device=x.device).int())
+            output[nan_mask] = nan_embedding
+
+        if feature < 11:
+            # input is int for embedding
+            x = x.int()
+            output[~nan_mask] = self.embeddings[feature](x[~nan_mask])
+        else:
+            x = x.unsqueeze(-1)
+            output[~nan_mask] = self.embeddings[feature](x[~nan_mask])
+
+        return output
+
+    def forward(self, x: t.Tensor):
+        B, T, D = x.size()
+        x = x.view(B * T, D)
+
+        embeddings = [self.embed_feature(x[:, i], i) for i in range(D)]
+        embeddings = t.stack(embeddings, dim=2)
+
+        if self.full:
+            pos_emb = self.pos_emb(t.arange(D, device=x.device))
+            pos_emb = pos_emb.repeat(B * T, 1, 1).flatten(1)
+            embeddings = embeddings.flatten(1)
+            embeddings = embeddings + pos_emb
+        embeddings = self.act(embeddings)
+
+        if self.tokens:
+            return embeddings.view(B, T, D, self.h_embedding_dim)
+        return embeddings.view(B, T, -1)
+
+
+def saved_bytes(function):
+    # bytes of the tensors autograd keeps for the backward pass of function()
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with t.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = function()
+    return output, sum(storages.values())
+
+
+def benchmark_attention(
+    batch_sizes,
+    backend="sdpa",
+    embedding_dim=157,
+    heads=16,
+    split_heads=False,
+    repeats=20,
+):
+    device = "cuda" if t.cuda.is_available() else "cpu"
+    module = importlib.import_module(families["transformer"])
+    reference = module.SelfAttention(embedding_dim, heads, "bmm", split_heads)
+    attention = module.SelfAttention(embedding_dim, heads, backend, split_heads)
+    # bmm checkpoints load into every backend
+    attention.load_state_dict(reference.state_dict())
+    reference.to(device)
+    attention.to(device)
+
+    parameters, flops = module.attention_cost(embedding_dim, heads, split_heads)
+    print("Device:", device, "embedding_dim:", embedding_dim, "heads:", heads)
+    print("Split heads:", split_heads, "parameters:", parameters, "FLOPs:", flops)
+
+    rows = []
+    for batch_size in batch_sizes:
+        x = t.randn(batch_size, 13, embedding_dim, device=device, requires_grad=True)
+        expected, reference_bytes = saved_bytes(lambda: reference(x))
+        output, backend_bytes = saved_bytes(lambda: attention(x))
+        error = (output - expected).abs().max().item()
+
+        step = lambda layer: layer(x).sum().backward()
+        reference_seconds = cuda_time(lambda: step(reference), repeats)
+        backend_seconds = cuda_time(lambda: step(attention), repeats)
+        rows.append(
+            (
+                batch_size,
+                reference_seconds,
+                backend_seconds,
+                reference_bytes,
+                backend_bytes,
+                error,
+            )
+        )
+
+    print(
+        f"{'batch':>6}{'bmm ms':>10}{backend + ' ms':>10}{'speedup':>9}"
+        f"{'bmm MB':>10}{backend + ' MB':>10}{'max diff':>11}"
+    )
+    for batch_size, bmm_s, backend_s, bmm_bytes, backend_bytes, error in rows:
+        print(
+            f"{batch_size:>6}{bmm_s * 1000:>10.2f}{backend_s * 1000:>10.2f}"
+            f"{bmm_s / backend_s:>9.2f}{bmm_bytes / 1024**2:>10.2f}"
+            f"{backend_bytes / 1024**2:>10.2f}{error:>11.2e}"
+        )
+    return rows
+
+
+def benchmark_tokens(
+    batch_sizes, feature_embed_dim=1, token_dim=16, num_heads=8, depth=6, repeats=5
+):
+    device = "cuda" if t.cuda.is_available() else "cpu"
+    module = importlib.import_module(families["transformer"])
+    params = model_params(
+        in_features=157,
+        feature_embed_dim=feature_embed_dim,
+        token_dim=token_dim,
+        num_heads=num_heads,
+        depth=depth,
+        nan_prob=0.4,
+    )
+    models = {
+        "statement": module.Transformer(params),
+        "feature": module.FeatureTokenTransformer(params),
+    }
+    print("Device:", device, "feature_embed_dim:", feature_embed_dim)
+    print("token_dim:", token_dim)
+
+    rows = []
+    for name, model in models.items():
+        model.to(device).train()
+        n_parameters = sum(p.numel() for p in model.parameters())
+        for batch_size in batch_sizes:
+            x = random_statements(model.embedding, batch_size, device)
+            step = lambda: model(x.clone()).sum().backward()
+            _, activations = saved_bytes(lambda: model(x.clone()))
+            seconds = cuda_time(step, repeats, warmup=1)
+            rows.append((name, batch_size, n_parameters, seconds, activations))
+
+    print(
+        f"{'tokens':<11}{'batch':>6}{'parameters':>13}{'step ms':>10}"
+        f"{'activations MB':>16}"
+    )
+    for name, batch_size, n_parameters, seconds, activations in rows:
+        print(
+            f"{name:<11}{batch_size:>6}{n_parameters:>13}{seconds * 1000:>10.1f}"
+            f"{activations / 1024**2:>16.1f}"
+        )
+    return rows
+
+
+def library_axial_layers(embedding_dim, num_layers, dropout):
+    # the former AxialLayers (without residual), None without axial_attention
+    try:
+        from axial_attention import AxialAttention
+    except ImportError:
+        return None
+    layer = lambda: t.nn.Sequential(
+        AxialAttention(embedding_dim, 2), t.nn.Dropout(dropout), t.nn.GELU()
+    )
+    return t.nn.Sequential(*[layer() for _ in range(num_layers)])
+
+
+def benchmark_axial(batch_sizes, repeats=5):
+    device = "cuda" if t.cuda.is_available() else "cpu"
+    with open(axial_hyperparameters) as file:
+        hparams = json.load(file)["hparams"]
+    params = model_params(**hparams)
+    module = importlib.import_module(families["axial"])
+    print("Device:", device, "hparams:", hparams)
+
+    models = {"native": module.AxialClassifier(params)}
+    library = library_axial_layers(hparams["feature_embed_dim"], hparams["depth"], 0.2)
+    if library is None:
+        print("axial_attention is not installed, only the native blocks are timed")
+    else:
+        models["library"] = module.AxialClassifier(params)
+        models["library"].axial_layers = library
+
+    rows = []
+    for name, model in models.items():
+        model.to(device).train()
+        n_parameters = sum(p.numel() for p in model.parameters())
+        for batch_size in batch_sizes:
+            x = random_statements(model.embedding, batch_size, device)
+            step = lambda: model(x.clone()).sum().backward()
+            seconds = cuda_time(step, repeats, warmup=1)
+            rows.append((name, batch_size, n_parameters, seconds))
+
+    print(
+        f"{'layers':<9}{'batch':>6}{'parameters':>13}{'step ms':>10}"
+        f"{'customers/s':>13}"
+    )
+    for name, batch_size, n_parameters, seconds in rows:
+        print(
+            f"{name:<9}{batch_size:>6}{n_parameters:>13}{seconds * 1000:>10.1f}"
+            f"{batch_size / seconds:>13.1f}"
+        )
+    return rows
+
+
+def benchmark_embedding(batch_sizes, feature_embed_dim=4, repeats=20):
+    device = "cuda" if t.cuda.is_available() else "cpu"
+    params = model_params(feature_embed_dim=feature_embed_dim, in_features=157)
+    print("Device:", device, "feature_embed_dim:", feature_embed_dim)
+
+    rows = []
+    with t.no_grad():
+        for family, name in families.items():
+            module = importlib.import_module(name)
+            baseline = BaselineEmbedding(params, **baselines[family]).eval()
+            # the former weights, loaded through the checkpoint hook
+            embedding = module.TabularEmbedding(params).eval()
+            embedding.load_state_dict(baseline.state_dict())
+            baseline.to(device)
+            embedding.to(device)
+            for batch_size in batch_sizes:
+                x = random_statements(embedding, batch_size, device)
+                error = (embedding(x) - baseline(x)).abs().max().item()
+                baseline_seconds = cuda_time(lambda: baseline(x), repeats)
+                fused_seconds = cuda_time(lambda: embedding(x), repeats)
+                seconds = (baseline_seconds, fused_seconds)
+                rows.append((family, batch_size, *seconds, error))
+
+    print(
+        f"{'family':<12}{'batch':>6}{'former ms':>11}{'fused ms':>10}"
+        f"{'speedup':>9}{'max diff':>11}"
+    )
+    for family, batch_size, baseline_seconds, fused_seconds, error in rows:
+        print(
+            f"{family:<12}{batch_size:>6}{baseline_seconds * 1000:>11.2f}"
+            f"{fused_seconds * 1000:>10.3f}{baseline_seconds / fused_seconds:>9.1f}"
+            f"{error:>11.2e}"
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    embedding = subparsers.add_parser("embedding")
+    embedding.add_argument("--batch-sizes", default="8,16,32,64,128,256")
+    embedding.add_argument("--feature-embed-dim", type=int, default=4)
+    embedding.add_argument("--repeats", type=int, default=20)
+
+    attention = subparsers.add_parser("attention")
+    attention.add_argument("--batch-sizes", default="8,16,32,64,128,256")
+    attention.add_argument("--backend", default="sdpa")
+    attention.add_argument("--embedding-dim", type=int, default=157)
+    attention.add_argument("--heads", type=int, default=16)
+    attention.add_argument("--split-heads", action="store_true")
+    attention.add_argument("--repeats", type=int, default=20)
+
+    tokens = subparsers.add_parser("tokens")
+    tokens.add_argument("--batch-sizes", default="64,256")
+    tokens.add_argument("--feature-embed-dim", type=int, default=1)
+    tokens.add_argument("--token-dim", type=int, default=16)
+    tokens.add_argument("--num-heads", type=int, default=8)
+    tokens.add_argument("--depth", type=int, default=6)
+    tokens.add_argument("--repeats", type=int, default=5)
+
+    axial = subparsers.add_parser("axial")
+    axial.add_argument("--batch-sizes", default="8,32")
+    axial.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.benchmark == "axial":
+        benchmark_axial(
+            [int(size) for size in args.batch_sizes.split(",")], args.repeats
+        )
+    elif args.benchmark == "tokens":
+        benchmark_tokens(
+            [int(size) for size in args.batch_sizes.split(",")],
+            args.feature_embed_dim,
+            args.token_dim,
+            args.num_heads,
+            args.depth,
+            args.repeats,
+        )
+    elif args.benchmark == "attention":
+        benchmark_attention(
+            [int(size) for size in args.batch_sizes.split(",")],
+            args.backend,
+            args.embedding_dim,
+            args.heads,
+            args.split_heads,
+            args.repeats,
+        )
+    elif args.benchmark == "embedding":
+        benchmark_embedding(
+            [int(size) for size in args.batch_sizes.split(",")],
+            args.feature_embed_dim,
+            args.repeats,
+        )
@@ -6,50 +6,98 @@ import ipdb
 from tqdm import tqdm
 from sklearn.preprocessing import StandardScaler
 
-
-def run(model: nn.Module):
-
-    model.eval()
-    model.to("cuda")
-
-    input = t.load("./amex/exec/test_tensor.pt")
-    df = pd.read_csv("./amex/exec/test_customer_ids.csv")
-    batch_size = 32
-    tot_size = input.shape[0]
-    num_batches = int(tot_size / batch_size)
+from amex.data_loaders.amex.customer_index import CustomerIndex
+from amex.data_loaders.amex.preprocess import date_format, read_lean
+from amex.data_loaders.amex.stats import load_stats, normalizer
+from amex.data_loaders.amex.tensor_store import (
+    expand_x,
+    is_sharded_store,
+    is_tensor_store,
+    load_header,
+    load_shards,
+    load_tensor_store,
+    read_customers,
+    x_arrays,
+)
+
+
+def predict(model, header, inputs, batch_size=32, normalize=None):
+    tot_size = inputs[-1].shape[0]
     preds = []
 
     with t.no_grad():
-        for i in tqdm(range(num_batches)):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            batch = input[start:end].to("cuda")
-            pred = model(batch)
+        for start in tqdm(range(0, tot_size, batch_size)):
+            end = min(start + batch_size, tot_size)
+            batch = read_customers(header, inputs, start, end)
+            batch = [tensor.to("cuda") for tensor in batch]
+            x = expand_x(header, batch)
+            if normalize is not None:
+                normalize(x)
+            pred = model(x)
             preds += [pred.flatten().cpu()]
             del batch
 
-    preds = t.stack(preds).flatten()
-    
-    # ipdb.set_trace()
-    remaining = tot_size - num_batches * batch_size
-    if remaining > 0:
-        batch = input[-remaining:].to("cuda")
-        pred = model(batch)
-        preds = t.cat([preds, pred.flatten().cpu()], dim=0)
+    return t.cat(preds).detach().numpy()
 
-    # ipdb.set_trace()
-    # all_preds = t.stack(preds[:-1])
-    preds = preds.flatten().detach().numpy()
 
+def store_normalizer(store, header, normalization):
+    # the normalization the model was trained with, from the training
+    # statistics that preprocess_test copied into the test store
+    if normalization not in ("tanh", "sigmoid", "standard"):
+        return None
+    stats = load_stats(store)
+    if stats is None:
+        raise ValueError(f"{normalization} normalization without statistics in {store}")
+    return normalizer(stats, normalization, header.get("n_categorical", 11))
+
+
+def submission(index, preds, path="./amex/exec/submission.csv"):
+    # preds in store row order; the keys are only turned into strings here
+    df = pd.DataFrame({"customer_ID": index.customer_ids()})
+    df["prediction"] = preds[index.rows]
+    df.to_csv(path, index=False)
+
+
+def run(model: nn.Module, store="./amex/exec/test_store", normalization="none"):
+    model.eval()
+    model.to("cuda")
+
+    if is_sharded_store(store):
+        # preprocess_test output: shard by shard, each with its customer_IDs
+        shards = load_shards(store)
+        normalize = store_normalizer(store, load_header(shards[0][0]), normalization)
+        preds = []
+        for path, _, _ in shards:
+            header = load_header(path)
+            inputs = load_tensor_store(path, x_arrays(header))
+            preds.append(predict(model, header, inputs, normalize=normalize))
+        submission(CustomerIndex.from_store(store), np.concatenate(preds))
+        return
+
+    if is_tensor_store(store):
+        # memory mapped; compact stores are copied as is and expanded on device
+        header = load_header(store)
+        inputs = load_tensor_store(store, x_arrays(header))
+    else:
+        header = {"layout": "dense"}
+        inputs = [t.load("./amex/exec/test_tensor.pt")]
+    normalize = store_normalizer(store, header, normalization)
+    preds = predict(model, header, inputs, normalize=normalize)
+    if "customer_ID" in header.get("arrays", {}):
+        submission(CustomerIndex.from_store(store), preds)
+        return
+
+    # stores written before the customer_ID array, and test_tensor.pt
+    df = pd.read_csv("./amex/exec/test_customer_ids.csv")
     # ipdb.set_trace()
     df["prediction"] = preds
     df.to_csv("./amex/exec/submission.csv", index=False)
 
 
 def load_test_df(test_file):
-    test = pd.read_parquet(test_file)
+    test = read_lean(test_file)
     # ipdb.set_trace()
-    test["S_2"] = pd.to_datetime(test["S_2"])
+    test["S_2"] = pd.to_datetime(test["S_2"], format=date_format)
 
     # count of unique customer_ID's
     tmp = test[["customer_ID", "S_2"]].groupby("customer_ID").count()
@@ -1,5 +1,4 @@
 from turtle import forward
-import torch
 from torch import nn
 import torch.nn.functional as F
 import ipdb
@@ -9,6 +8,17 @@ from .conv1d.conv1d import GaussianNoise, Conv1DLayers
 
 
 class TabularEmbedding(nn.Module):
+    """
+    embeds every feature of every statement in one pass: the 11 categorical
+    features share one table (each at its offset), the continuous features are
+    projected together as x * weight + bias (the nn.Linear(1, h) of each
+    feature), and NaN values take the NaN embedding through t.where. No loop
+    over features and no shape depends on the data.
+    """
+
+    # number of categories of the categorical features, in column order
+    categories = [2, 2, 2, 2, 3, 3, 4, 6, 7, 7, 7]
+
     def __init__(self, params):
         super().__init__()
         self.params = params
@@ -17,31 +27,20 @@ class TabularEmbedding(nn.Module):
         h_embedding = params.hparams.feature_embed_dim
 
         in_features = 157
+        self.n_categorical = len(self.categories)
+        self.n_continuous = in_features - self.n_categorical
 
-        embedding_type_dict = {}
-        for i in range(4):
-            embedding_type_dict[i] = nn.Embedding(2, h_embedding)
-
-        for i in range(4, 6):
-            embedding_type_dict[i] = nn.Embedding(3, h_embedding)
+        offsets = t.tensor([0] + self.categories[:-1]).cumsum(0)
+        self.register_buffer("offsets", offsets, persistent=False)
+        self.categorical = nn.Embedding(sum(self.categories), h_embedding)
 
-        for i in range(6, 7):
-            embedding_type_dict[i] = nn.Embedding(4, h_embedding)
-
-        for i in range(7, 8):
-            embedding_type_dict[i] = nn.Embedding(6, h_embedding)
-
-        for i in range(8, 11):
-            embedding_type_dict[i] = nn.Embedding(7, h_embedding)
-
-        for i in range(11, in_features):
-            embedding_type_dict[i] = (
-                nn.Sequential(GaussianNoise(0.001))
-                if h_embedding == 1
-                else nn.Sequential(GaussianNoise(0.001), nn.Linear(1, h_embedding))
-            )
-
-        self.embeddings = nn.ModuleList(list(embedding_type_dict.values()))
+        self.noise = GaussianNoise(0.001)
+        self.project = h_embedding > 1
+        if self.project:
+            # initialized like nn.Linear(1, h): uniform in +-1 / sqrt(1)
+            shape = (self.n_continuous, h_embedding)
+            self.continuous_weight = nn.Parameter(t.empty(shape).uniform_(-1, 1))
+            self.continuous_bias = nn.Parameter(t.empty(shape).uniform_(-1, 1))
 
         self.na_embedding = nn.Embedding(1, h_embedding)
 
@@ -49,79 +48,125 @@ class TabularEmbedding(nn.Module):
 
         self.pos_emb = nn.Embedding(params.hparams.in_features, h_embedding)
 
-    def __embedd_feature(self, x: t.Tensor, feature: int):
-        (B,) = x.size()
+        self._register_load_state_dict_pre_hook(self.load_legacy_state)
+
+    def load_legacy_state(self, state_dict, prefix, *args):
+        # checkpoints of the former per feature modules, embeddings.<feature>.*
+        if prefix + "embeddings.0.weight" not in state_dict:
+            return
+        tables = [
+            state_dict.pop(f"{prefix}embeddings.{i}.weight")
+            for i in range(self.n_categorical)
+        ]
+        state_dict[prefix + "categorical.weight"] = t.cat(tables)
+        if not self.project:
+            return
+
+        continuous = range(self.n_categorical, self.n_categorical + self.n_continuous)
+        linears = [f"{prefix}embeddings.{i}.1." for i in continuous]
+        state_dict[prefix + "continuous_weight"] = t.stack(
+            [state_dict.pop(key + "weight")[:, 0] for key in linears]
+        )
+        state_dict[prefix + "continuous_bias"] = t.stack(
+            [state_dict.pop(key + "bias") for key in linears]
+        )
 
-        # find nans over batch
-        nan_mask = t.isnan(x)
-        nan_count = nan_mask.sum()
+    def embed_features(self, x: t.Tensor):
+        # x: (N, D) -> (N, D, h)
+        nan_mask = t.isnan(x).unsqueeze(-1)
+        x = t.nan_to_num(x, nan=0.0)
 
-        output = t.zeros(B, self.h_embedding_dim, device=x.device)
-        if nan_count > 0:
-            # if there are nans, we need to replace them nan embeddings
-            nan_embedding = self.na_embedding(t.zeros(nan_count, device=x.device).int())
-            output[nan_mask] = nan_embedding
+        codes = x[:, : self.n_categorical].long() + self.offsets
+        categorical = self.categorical(codes)
 
-        if feature < 11:
-            # input is int for embedding
-            x = x.int()
-            output[~nan_mask] = self.embeddings[feature](x[~nan_mask])
-        else:
-            x = x.unsqueeze(-1)
-            output[~nan_mask] = self.embeddings[feature](x[~nan_mask])
+        continuous = self.noise(x[:, self.n_categorical :]).unsqueeze(-1)
+        if self.project:
+            continuous = continuous * self.continuous_weight + self.continuous_bias
 
-        return output
+        embeddings = t.cat([categorical, continuous], dim=1)
+        return t.where(nan_mask, self.na_embedding.weight[0], embeddings)
 
     def forward(self, x: t.Tensor):
-        # ipdb.set_trace()
         B, T, D = x.size()
-        x = x.view(B * T, D)
-
-        embeddings = [self.__embedd_feature(x[:, i], i) for i in range(D)]
-        embeddings = torch.stack(embeddings, dim=2)
+        embeddings = self.embed_features(x.reshape(B * T, D))
 
-        pos_emb = self.pos_emb(t.arange(D, device=x.device))
-        pos_emb = pos_emb.repeat(B * T, 1, 1).flatten(1)
-        # ipdb.set_trace()
-        embeddings = embeddings.flatten(1)
-        embeddings = embeddings + pos_emb
+        # the layout of the former per feature loop: h blocks of D features,
+        # plus the positional embedding flattened as (D, h)
+        embeddings = embeddings.transpose(1, 2).flatten(1)
+        embeddings = embeddings + self.pos_emb.weight[:D].flatten()
         embeddings = self.act(embeddings)
 
         embeddings = embeddings.view(B, T, D, self.h_embedding_dim)
         return embeddings
 
 
-from axial_attention import AxialAttention
+class AxialBlock(nn.Module):
+    """
+    self attention over both axes of (B, T, D, H) tokens with one QKV projection
+    shared by the axes: the statements of every feature and the features of
+    every statement attend through F.scaled_dot_product_attention on strided
+    views of the projection, and the two outputs are summed, as AxialAttention
+    did, before one output projection. pre_norm: LayerNorm before the
+    projection, residual: the input is added to the output.
+    """
+
+    def __init__(self, dim, heads=8, dropout=0.2, residual=False, pre_norm=False):
+        super().__init__()
+        if dim % heads != 0:
+            raise ValueError(f"dim {dim} is not divisible by {heads} heads")
+        self.heads = heads
+        self.residual = residual
+
+        self.norm = nn.LayerNorm(dim) if pre_norm else nn.Identity()
+        self.to_qkv = nn.Linear(dim, 3 * dim, bias=False)
+        self.to_out = nn.Linear(dim, dim)
+        self.do = nn.Dropout(dropout)
+        self.act = nn.GELU()
+
+    def forward(self, x):
+        B, T, D, H = x.shape
+        qkv = self.to_qkv(self.norm(x)).view(B, T, D, 3, self.heads, H // self.heads)
+
+        # over time: batch (B, D, heads), sequence T
+        queries, keys, values = qkv.permute(3, 0, 2, 4, 1, 5).unbind(0)
+        time = F.scaled_dot_product_attention(queries, keys, values)
+        # over features: batch (B, T, heads), sequence D
+        queries, keys, values = qkv.permute(3, 0, 1, 4, 2, 5).unbind(0)
+        features = F.scaled_dot_product_attention(queries, keys, values)
+
+        # both to (B, T, D, heads, head_dim), one copy for the output projection
+        out = time.permute(0, 3, 1, 2, 4) + features.permute(0, 1, 3, 2, 4)
+        out = self.to_out(out.reshape(B, T, D, H))
+        out = self.act(self.do(out))
+        return out + x if self.residual else out
 
 
 class AxialLayers(nn.Module):
-    def __init__(self, embedding_dim, num_layers, dropout, residual=False):
+    def __init__(
+        self,
+        embedding_dim,
+        num_layers,
+        dropout,
+        residual=False,
+        heads=8,
+        pre_norm=False,
+    ):
         super().__init__()
         self.embedding_dim = embedding_dim
         self.num_layers = num_layers
         self.dropout = dropout
         self.residual = residual
 
-        self.attention = AxialAttention(embedding_dim)
-
         self.layers = nn.ModuleList(
             [
-                nn.Sequential(
-                    AxialAttention(embedding_dim, 2),
-                    nn.Dropout(dropout),
-                    nn.GELU(),
-                )
+                AxialBlock(embedding_dim, heads, dropout, residual, pre_norm)
                 for _ in range(num_layers)
             ]
         )
 
     def forward(self, x):
-        for i in range(self.num_layers):
-            x_ = self.layers[i](x)
-            if self.residual:
-                x = x_ + x
-            else:
-                x = x_
+        for layer in self.layers:
+            x = layer(x)
         return x
 
 
@@ -149,11 +194,16 @@ class AxialClassifier(nn.Module):
             nn.Flatten(), nn.Linear(embedding_dim * 157, 1)
         )
 
+        # residual and pre-norm axial blocks, off by default like the former layers
+        residual = hparams.residual if hparams.contains("residual") else False
+        pre_norm = hparams.pre_norm if hparams.contains("pre_norm") else False
         self.axial_layers = AxialLayers(
             embedding_dim=embedding_dim,
             num_layers=depth,
             dropout=dropout,
-            residual=False,
+            residual=residual,
+            heads=hparams.num_heads,
+            pre_norm=pre_norm,
         )
 
         self.noise = GaussianNoise(0.0001)
@@ -21,15 +21,36 @@ class BaseClassificationModel(LightningModule):
         self.classifier : t.nn.Module
         self.critarion = t.nn.BCELoss()
         self.loss = lambda x, y: self.critarion(x.flatten(), y.flatten())
+        # per-sample losses, weighted by prioritized sampling
+        self.sample_critarion = t.nn.BCELoss(reduction="none")
+        self.sample_loss = lambda x, y: self.sample_critarion(x.flatten(), y.flatten())
 
     def forward(self, z: t.Tensor) -> t.Tensor:
         out = self.classifier(z)
         return out
 
+    def sampled_loss(self, y_pred, labels, idx, weights):
+        # prioritized batches: importance weighted loss, and the per-sample
+        # losses become the new priorities of the batch
+        losses = self.sample_loss(y_pred, labels).flatten()
+        self.trainer.datamodule.update_priorities(idx, losses.detach())
+        return (losses * weights).mean()
+
+    def on_fit_start(self):
+        # the attention cost of the networks, once per run rather than per build
+        for module in self.modules():
+            if hasattr(module, "attention_cost"):
+                parameters, flops = module.attention_cost
+                name = type(module).__name__
+                print(name, "attention parameters:", parameters, "FLOPs:", flops)
+
     def training_step(self, batch: tuple[t.Tensor, t.Tensor], batch_idx: int):
-        x, labels = batch
+        x, labels, *sampled = batch
         y_pred = self.classifier(x)
-        loss = self.loss(y_pred, labels)
+        if sampled:
+            loss = self.sampled_loss(y_pred, labels, *sampled)
+        else:
+            loss = self.loss(y_pred, labels)
         return {"loss": loss}
 
     def training_epoch_end(self, outputs):
@@ -9,60 +9,125 @@ from .conv1d.conv1d import GaussianNoise, Conv1DLayers
 
 
 class SelfAttention(nn.Module):
-    def __init__(self, embedding_dim, heads):
+    """
+    multi head self attention with the "bmm" or fused "sdpa" backend, heads
+    embedding_dim wide or, with split_heads, ceil(embedding_dim / heads) wide
+    """
+
+    def __init__(self, embedding_dim, heads, backend="bmm", split_heads=False):
         super().__init__()
         self.embedding_dim = embedding_dim
         self.heads = heads
-        self.to_keys = nn.Linear(embedding_dim, embedding_dim * heads, bias=False)
-        self.to_queries = nn.Linear(embedding_dim, embedding_dim * heads, bias=False)
-        self.to_values = nn.Linear(embedding_dim, embedding_dim * heads, bias=False)
-        self.unify_heads = nn.Linear(heads * embedding_dim, embedding_dim)
+        self.backend = backend
+        self.head_dim = attention_head_dim(embedding_dim, heads, split_heads)
+        inner_dim = heads * self.head_dim
+        if backend == "sdpa":
+            self.to_qkv = nn.Linear(embedding_dim, 3 * inner_dim, bias=False)
+            self._register_load_state_dict_pre_hook(self.load_qkv_state)
+        elif backend == "bmm":
+            self.to_keys = nn.Linear(embedding_dim, inner_dim, bias=False)
+            self.to_queries = nn.Linear(embedding_dim, inner_dim, bias=False)
+            self.to_values = nn.Linear(embedding_dim, inner_dim, bias=False)
+        else:
+            raise ValueError(f"Unknown attention backend {backend}")
+        self.unify_heads = nn.Linear(inner_dim, embedding_dim)
+
+    def load_qkv_state(self, state_dict, prefix, *args):
+        # checkpoints of the bmm backend, to_queries / to_keys / to_values
+        if prefix + "to_queries.weight" not in state_dict:
+            return
+        state_dict[prefix + "to_qkv.weight"] = t.cat(
+            [
+                state_dict.pop(prefix + f"to_{name}.weight")
+                for name in ("queries", "keys", "values")
+            ]
+        )
 
     def forward(self, x):
-        # ipdb.set_trace()
-        batch_size, tweet_length, embedding_dim = x.size()
-        keys = self.to_keys(x).view(batch_size, tweet_length, self.heads, embedding_dim)
+        if self.backend == "sdpa":
+            return self.fused_forward(x)
+        batch_size, tweet_length, _ = x.size()
+        head_dim = self.head_dim
+        keys = self.to_keys(x).view(batch_size, tweet_length, self.heads, head_dim)
         queries = self.to_queries(x).view(
-            batch_size, tweet_length, self.heads, embedding_dim
-        )
-        values = self.to_values(x).view(
-            batch_size, tweet_length, self.heads, embedding_dim
+            batch_size, tweet_length, self.heads, head_dim
         )
+        values = self.to_values(x).view(batch_size, tweet_length, self.heads, head_dim)
         keys = (
             keys.transpose(1, 2)
             .contiguous()
-            .view(batch_size * self.heads, tweet_length, embedding_dim)
+            .view(batch_size * self.heads, tweet_length, head_dim)
         )
         queries = (
             queries.transpose(1, 2)
             .contiguous()
-            .view(batch_size * self.heads, tweet_length, embedding_dim)
+            .view(batch_size * self.heads, tweet_length, head_dim)
         )
         values = (
             values.transpose(1, 2)
             .contiguous()
-            .view(batch_size * self.heads, tweet_length, embedding_dim)
+            .view(batch_size * self.heads, tweet_length, head_dim)
         )
-        queries = queries / (embedding_dim ** (1 / 4))
-        keys = keys / (embedding_dim ** (1 / 4))
+        queries = queries / (head_dim ** (1 / 4))
+        keys = keys / (head_dim ** (1 / 4))
 
         dot = F.softmax(torch.bmm(queries, keys.transpose(1, 2)), dim=2)
 
         out = torch.bmm(dot, values).view(
-            batch_size, self.heads, tweet_length, embedding_dim
+            batch_size, self.heads, tweet_length, head_dim
         )
         out = (
             out.transpose(1, 2)
             .contiguous()
-            .view(batch_size, tweet_length, self.heads * embedding_dim)
+            .view(batch_size, tweet_length, self.heads * head_dim)
+        )
+        return self.unify_heads(out)
+
+    def fused_forward(self, x):
+        batch_size, tweet_length, _ = x.size()
+        head_dim = self.head_dim
+        # (3, B, heads, T, head_dim) without copies until the attention kernel
+        qkv = self.to_qkv(x).view(batch_size, tweet_length, 3, self.heads, head_dim)
+        queries, keys, values = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+        # default scale 1 / sqrt(head_dim), as head_dim ** (1 / 4) on q and k above
+        out = F.scaled_dot_product_attention(queries, keys, values)
+        out = out.transpose(1, 2).reshape(
+            batch_size, tweet_length, self.heads * head_dim
         )
         return self.unify_heads(out)
 
 
+def attention_head_dim(embedding_dim, heads, split_heads=False):
+    # split heads share embedding_dim, otherwise every head is embedding_dim wide.
+    # An embedding_dim that heads do not divide, e.g. 157 features, is padded
+    if not split_heads:
+        return embedding_dim
+    return -(-embedding_dim // heads)
+
+
+def attention_cost(embedding_dim, heads, split_heads=False, seq_length=13):
+    # parameters of a SelfAttention and its forward FLOPs on one sequence,
+    # counting a multiply-add as 2
+    inner_dim = heads * attention_head_dim(embedding_dim, heads, split_heads)
+    parameters = 4 * embedding_dim * inner_dim + embedding_dim
+    projections = 2 * 4 * seq_length * embedding_dim * inner_dim
+    attention = 2 * 2 * seq_length * seq_length * inner_dim
+    return parameters, projections + attention
+
+
 class TransformerBlock(nn.Module):
-    def __init__(self, embedding_dim, num_heads, fc_hidden_multiply=4, dropout=0.02):
+    def __init__(
+        self,
+        embedding_dim,
+        num_heads,
+        fc_hidden_multiply=4,
+        dropout=0.02,
+        attention="bmm",
+        split_heads=False,
+    ):
         super().__init__()
-        self.attention = SelfAttention(embedding_dim, num_heads)
+        self.attention = SelfAttention(embedding_dim, num_heads, attention, split_heads)
         self.norm1 = nn.LayerNorm(embedding_dim)
         self.norm2 = nn.LayerNorm(embedding_dim)
         self.fc = nn.Sequential(
@@ -88,6 +153,17 @@ class TransformerBlock(nn.Module):
 
 
 class TabularEmbedding(nn.Module):
+    """
+    embeds every feature of every statement in one pass: the 11 categorical
+    features share one table (each at its offset), the continuous features are
+    scaled together as x * weight + bias (the nn.Linear(1, 1) of each feature),
+    and NaN values take the NaN embedding through t.where. No loop over features
+    and no shape depends on the data.
+    """
+
+    # number of categories of the categorical features, in column order
+    categories = [2, 2, 2, 2, 3, 3, 4, 6, 7, 7, 7]
+
     def __init__(self, params):
         super().__init__()
         self.params = params
@@ -96,66 +172,66 @@ class TabularEmbedding(nn.Module):
         self.h_embedding_dim = params.hparams.feature_embed_dim
 
         in_features = 157
+        self.n_categorical = len(self.categories)
+        self.n_continuous = in_features - self.n_categorical
 
-        embedding_type_dict = {}
-        for i in range(4):
-            embedding_type_dict[i] = nn.Embedding(2, h_embedding)
-
-        for i in range(4, 6):
-            embedding_type_dict[i] = nn.Embedding(3, h_embedding)
-
-        for i in range(6, 7):
-            embedding_type_dict[i] = nn.Embedding(4, h_embedding)
-
-        for i in range(7, 8):
-            embedding_type_dict[i] = nn.Embedding(6, h_embedding)
-
-        for i in range(8, 11):
-            embedding_type_dict[i] = nn.Embedding(7, h_embedding)
-
+        offsets = t.tensor([0] + self.categories[:-1]).cumsum(0)
+        self.register_buffer("offsets", offsets, persistent=False)
+        self.categorical = nn.Embedding(sum(self.categories), h_embedding)
 
-        for i in range(11, in_features):
-            embedding_type_dict[str(i)] = nn.Linear(1, h_embedding)
-
-        self.embeddings = nn.ModuleList(list(embedding_type_dict.values()))
+        # initialized like nn.Linear(1, 1): uniform in +-1
+        shape = (self.n_continuous, h_embedding)
+        self.continuous_weight = nn.Parameter(t.empty(shape).uniform_(-1, 1))
+        self.continuous_bias = nn.Parameter(t.empty(shape).uniform_(-1, 1))
 
         self.na_embedding = nn.Embedding(1, h_embedding)
 
         self.act = nn.LeakyReLU(0.2)
 
-    def __embedd_feature(self, x: t.Tensor, feature: int):
-        (B,) = x.size()
+        self._register_load_state_dict_pre_hook(self.load_legacy_state)
+
+    def load_legacy_state(self, state_dict, prefix, *args):
+        # checkpoints of the former per feature modules, embeddings.<feature>.*
+        if prefix + "embeddings.0.weight" not in state_dict:
+            return
+        tables = [
+            state_dict.pop(f"{prefix}embeddings.{i}.weight")
+            for i in range(self.n_categorical)
+        ]
+        state_dict[prefix + "categorical.weight"] = t.cat(tables)
+
+        continuous = range(self.n_categorical, self.n_categorical + self.n_continuous)
+        linears = [f"{prefix}embeddings.{i}." for i in continuous]
+        state_dict[prefix + "continuous_weight"] = t.stack(
+            [state_dict.pop(key + "weight")[:, 0] for key in linears]
+        )
+        state_dict[prefix + "continuous_bias"] = t.stack(
+            [state_dict.pop(key + "bias") for key in linears]
+        )
 
-        # find nans over batch
-        nan_mask = t.isnan(x)
-        nan_count = nan_mask.sum()
+    def embed_features(self, x: t.Tensor):
+        # x: (N, D) -> (N, D, h)
+        nan_mask = t.isnan(x).unsqueeze(-1)
+        x = t.nan_to_num(x, nan=0.0)
 
-        output = t.zeros(B, self.h_embedding_dim, device=x.device)
-        if nan_count > 0:
-            # if there are nans, we need to replace them nan embeddings
-            nan_embedding = self.na_embedding(t.zeros(nan_count, device=x.device).int())
-            output[nan_mask] = nan_embedding
+        codes = x[:, : self.n_categorical].long() + self.offsets
+        categorical = self.categorical(codes)
 
-        if feature < 11:
-            # input is int for embedding
-            x = x.int()
-            output[~nan_mask] = self.embeddings[feature](x[~nan_mask])
-        else:
-            x = x.unsqueeze(-1)
-            output[~nan_mask] = self.embeddings[feature](x[~nan_mask])
+        continuous = x[:, self.n_categorical :].unsqueeze(-1)
+        continuous = continuous * self.continuous_weight + self.continuous_bias
 
-        return output
+        embeddings = t.cat([categorical, continuous], dim=1)
+        return t.where(nan_mask, self.na_embedding.weight[0], embeddings)
 
     def forward(self, x: t.Tensor):
-        # ipdb.set_trace()
         B, T, D = x.size()
-        x = x.view(B * T, D)
-
-        embeddings = [self.__embedd_feature(x[:, i], i) for i in range(D)]
-        embeddings = torch.stack(embeddings, dim=2)
+        embeddings = self.embed_features(x.reshape(B * T, D))
 
-        embeddings = self.act(embeddings)
-        embeddings = embeddings.view(B, T, -1)
+        # every feature repeated h_embedding_dim times, in h blocks of D
+        # features as the former per feature loop stacked them
+        embeddings = self.act(embeddings.transpose(1, 2))
+        embeddings = embeddings.expand(-1, self.h_embedding_dim, -1)
+        embeddings = embeddings.reshape(B, T, -1)
         return embeddings
 
 
@@ -178,10 +254,22 @@ class Transformer(nn.Module):
         self.positional_embedding = nn.Embedding(
             embedding_dim=embedding_dim, num_embeddings=seq_length
         )
+        # "sdpa": fused QKV projection and scaled_dot_product_attention
+        attention = hparams.attention if hparams.contains("attention") else "bmm"
+        # split_heads: num_heads heads of embedding_dim / num_heads
+        split_heads = hparams.split_heads if hparams.contains("split_heads") else False
+        # (parameters, FLOPs per customer), logged once when fitting starts
+        self.attention_cost = attention_cost(embedding_dim, num_heads, split_heads)
         transformer_blocks = []
         for _ in range(depth):
             transformer_blocks.append(
-                TransformerBlock(embedding_dim, num_heads, dropout=dropout)
+                TransformerBlock(
+                    embedding_dim,
+                    num_heads,
+                    dropout=dropout,
+                    attention=attention,
+                    split_heads=split_heads,
+                )
             )
 
         self.transformer_blocks = nn.Sequential(*transformer_blocks)
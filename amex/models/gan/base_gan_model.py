@@ -88,6 +88,14 @@ class BaseGANModel(LightningModule):
         loss = self.__adversarial_loss(pred_fake_x, true_label)
         return loss
 
+    def on_fit_start(self):
+        # the attention cost of the networks, once per run rather than per build
+        for module in self.modules():
+            if hasattr(module, "attention_cost"):
+                parameters, flops = module.attention_cost
+                name = type(module).__name__
+                print(name, "attention parameters:", parameters, "FLOPs:", flops)
+
     def training_step(
         self, batch: tuple[t.Tensor, t.Tensor], batch_idx: int, optimizer_idx: int
     ):
@@ -3,9 +3,16 @@ from .base_classification_model import BaseClassificationModel
 import torch as t
 from .modules.conv1d.conv1d import FATConv1dClassifier
 from .modules.lstm import LSTMClassifier
-from .modules.transformer import Transformer
+from .modules.transformer import FeatureTokenTransformer, Transformer
 
 class Model(BaseClassificationModel):
     def __init__(self, params: Namespace):
         super().__init__(params)
-        self.classifier = Transformer(params)
+        # "feature": a token per statement and feature instead of per statement
+        tokens = "statement"
+        if params.hparams.contains("tokens"):
+            tokens = params.hparams.tokens
+        if tokens == "feature":
+            self.classifier = FeatureTokenTransformer(params)
+        else:
+            self.classifier = Transformer(params)
@@ -0,0 +1,71 @@
+import importlib
+
+import pytest
+import torch as t
+
+from amex.models.transformer.modules.transformer import (
+    SelfAttention,
+    attention_cost,
+    attention_head_dim,
+)
+
+
+# the embedding sizes of the transformer configs (feature_embed_dim 1 and 3)
+@pytest.mark.parametrize("embedding_dim", [157, 471])
+@pytest.mark.parametrize("backend", ["bmm", "sdpa"])
+def test_split_heads_pads_the_embedding(embedding_dim, backend):
+    heads = 16
+    attention = SelfAttention(embedding_dim, heads, backend, split_heads=True)
+    head_dim = attention_head_dim(embedding_dim, heads, split_heads=True)
+    assert head_dim * heads >= embedding_dim > (head_dim - 1) * heads
+
+    x = t.randn(2, 13, embedding_dim)
+    assert attention(x).shape == x.shape
+
+    parameters = sum(p.numel() for p in attention.parameters())
+    assert parameters == attention_cost(embedding_dim, heads, True)[0]
+    assert parameters < attention_cost(embedding_dim, heads)[0]
+
+
+# every copy of SelfAttention and TransformerBlock
+attention_modules = [
+    "amex.models.transformer.modules.transformer",
+    "amex.models.c_emb.modules.transformer",
+    "amex.models.emb_2d.modules.transformer",
+    "amex.models.axial.modules.transformer",
+    "amex.models.conv1d.modules.conv1d.transformer",
+    "amex.models.conv2d.modules.transformer",
+    "amex.models.gan.modules.transformer",
+    "amex.models.gan.modules.transformer_g",
+]
+
+
+@pytest.mark.parametrize("split_heads", [False, True])
+@pytest.mark.parametrize("name", attention_modules)
+def test_sdpa_matches_bmm_with_the_same_weights(name, split_heads):
+    module = importlib.import_module(name)
+    t.manual_seed(0)
+    bmm = module.SelfAttention(157, 16, "bmm", split_heads)
+    sdpa = module.SelfAttention(157, 16, "sdpa", split_heads)
+    # a bmm checkpoint, to_queries / to_keys / to_values, through the pre-hook
+    sdpa.load_state_dict(bmm.state_dict())
+
+    x = t.randn(4, 13, 157)
+    with t.no_grad():
+        # the scale is applied in a different order
+        t.testing.assert_close(sdpa(x), bmm(x), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("name", attention_modules)
+def test_legacy_block_checkpoint_loads_into_sdpa(name):
+    module = importlib.import_module(name)
+    t.manual_seed(0)
+    bmm = module.TransformerBlock(157, 16, attention="bmm").eval()
+    sdpa = module.TransformerBlock(157, 16, attention="sdpa").eval()
+    state = bmm.state_dict()
+    assert any(key.endswith("to_queries.weight") for key in state)
+    sdpa.load_state_dict(state)
+
+    x = t.randn(4, 13, 157)
+    with t.no_grad():
+        t.testing.assert_close(sdpa(x), bmm(x), rtol=1e-4, atol=1e-5)
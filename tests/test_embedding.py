@@ -0,0 +1,59 @@
+import importlib
+
+import pytest
+import torch as t
+
+from amex.exec.benchmark_models import (
+    BaselineEmbedding,
+    baselines,
+    families,
+    model_params,
+    random_statements,
+)
+
+# axial/modules/transformer.py carries its own copy of the transformer embedding
+legacy_families = {
+    **{family: (name, baselines[family]) for family, name in families.items()},
+    "axial_transformer": (
+        "amex.models.axial.modules.transformer",
+        baselines["transformer"],
+    ),
+}
+
+
+@pytest.mark.parametrize("feature_embed_dim", [1, 3])
+@pytest.mark.parametrize("family", list(legacy_families))
+def test_legacy_checkpoint_matches_the_former_modules(family, feature_embed_dim):
+    name, kwargs = legacy_families[family]
+    t.manual_seed(0)
+    params = model_params(feature_embed_dim=feature_embed_dim, in_features=157)
+    baseline = BaselineEmbedding(params, **kwargs).eval()
+    # a checkpoint of the per feature modules, embeddings.<feature>.*
+    state = baseline.state_dict()
+    assert "embeddings.0.weight" in state
+
+    embedding = importlib.import_module(name).TabularEmbedding(params).eval()
+    embedding.load_state_dict(state)
+    x = random_statements(embedding, 16, "cpu")
+    with t.no_grad():
+        t.testing.assert_close(embedding(x), baseline(x))
+
+
+def test_layout_is_h_major_with_a_d_major_positional_embedding():
+    module = importlib.import_module(families["transformer"])
+    params = model_params(feature_embed_dim=3, in_features=157)
+    embedding = module.TabularEmbedding(params).eval()
+    x = t.full((1, 1, 157), t.nan)
+
+    with t.no_grad():
+        # h blocks of D features: the k-th NaN embedding value fills block k
+        embedding.pos_emb.weight.zero_()
+        embedding.na_embedding.weight.copy_(t.tensor([[0.0, 1.0, 2.0]]))
+        expected = t.arange(3.0).repeat_interleave(157)
+        t.testing.assert_close(embedding(x).flatten(), embedding.act(expected))
+
+        # the positional embedding is added flattened as (D, h)
+        embedding.na_embedding.weight.zero_()
+        embedding.pos_emb.weight.copy_(t.arange(157 * 3.0).view(157, 3) / 100)
+        expected = t.arange(157 * 3.0) / 100
+        t.testing.assert_close(embedding(x).flatten(), embedding.act(expected))
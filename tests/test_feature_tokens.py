@@ -0,0 +1,41 @@
+import json
+import os
+
+import pytest
+import torch as t
+
+from amex.exec.benchmark_models import model_params, random_statements
+from amex.models.transformer.modules.transformer import FeatureTokenTransformer
+
+hyperparameters = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "amex",
+    "models",
+    "transformer",
+    "hyperparameters",
+    "amex.json",
+)
+
+
+def shipped_hparams(**overrides):
+    with open(hyperparameters) as file:
+        hparams = json.load(file)["hparams"]
+    return model_params(**{**hparams, "tokens": "feature", **overrides})
+
+
+def test_different_inputs_give_different_outputs():
+    t.manual_seed(0)
+    model = FeatureTokenTransformer(shipped_hparams()).eval()
+    x = t.cat(
+        [random_statements(model.embedding, 4, "cpu", seed=seed) for seed in (0, 1)]
+    )
+    with t.no_grad():
+        output = model(x).flatten()
+    assert output.shape == (8,)
+    assert not t.allclose(output, output[0].expand_as(output))
+
+
+def test_rejects_tokens_narrower_than_two():
+    with pytest.raises(ValueError):
+        FeatureTokenTransformer(shipped_hparams(token_dim=1))
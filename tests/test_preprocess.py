@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from amex.data_loaders.amex import preprocess, synthetic
+from amex.data_loaders.amex.customer_index import CustomerIndex
+from amex.data_loaders.amex.tensor_store import load_header, open_array
+
+
+@pytest.fixture
+def amex_data(tmp_path, monkeypatch):
+    # synthetic train_data.parquet and train_labels.csv in the working directory
+    monkeypatch.chdir(tmp_path)
+    synthetic.generate(
+        preprocess.data_location, preprocess.train_labels, n_customers=300, seed=0
+    )
+    return tmp_path
+
+
+@pytest.mark.parametrize("lean", [False, True])
+@pytest.mark.parametrize("layout", ["dense", "compact", "ragged"])
+def test_preprocess_in_memory(amex_data, layout, lean):
+    preprocess.preprocess(layout=layout, lean=lean)
+
+    header = load_header(preprocess.tensor_store)
+    labels = pd.read_csv(preprocess.train_labels)
+    n_rows = len(pd.read_parquet(preprocess.data_location, columns=["S_2"]))
+    assert header["layout"] == layout
+    assert len(header["columns"]) > 0
+
+    # labels are written in customer_ID order, like the store
+    y = open_array(preprocess.tensor_store, "y", header)
+    np.testing.assert_array_equal(y, labels["target"].to_numpy(np.float32))
+    index = CustomerIndex.from_store(preprocess.tensor_store)
+    np.testing.assert_array_equal(index.customer_ids(), labels["customer_ID"])
+
+    if layout == "dense":
+        x = open_array(preprocess.tensor_store, "x", header)
+        assert x.shape == (len(labels), 13, len(header["columns"]))
+        assert (~np.isnan(x).all(axis=2)).sum() == n_rows
+    elif layout == "ragged":
+        lengths = open_array(preprocess.tensor_store, "lengths", header)
+        assert lengths.sum() == n_rows
+
+
+@pytest.mark.parametrize("lean", [False, True])
+def test_non_integer_float_category(amex_data, lean):
+    # B_30 as 0.1, 0.35 and 2.7, which float32 does not represent exactly
+    df = pd.read_parquet(preprocess.data_location)
+    df["B_30"] = df["B_30"].map({0.0: 0.1, 1.0: 0.35, 2.0: 2.7})
+    df.to_parquet(preprocess.data_location, index=False)
+
+    preprocess.preprocess(layout="dense", lean=lean)
+    header = load_header(preprocess.tensor_store)
+    x = open_array(preprocess.tensor_store, "x", header)
+    codes = x[..., header["columns"].index("B_30")]
+    codes = codes[~np.isnan(codes)]
+    assert len(codes) == df["B_30"].notna().sum()
+    assert set(codes.tolist()) == {0.0, 1.0, 2.0}
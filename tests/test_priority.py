@@ -0,0 +1,46 @@
+import numpy as np
+
+from amex.data_loaders.amex.priority import PrioritizedBatchSampler, SumTree
+
+
+def test_find_matches_the_prefix_sum():
+    rng = np.random.default_rng(0)
+    # integer priorities keep the sums exact, 1000 leaves do not fill the tree
+    priorities = rng.integers(0, 10, 1000).astype(np.float64)
+    tree = SumTree(len(priorities))
+    tree.update(np.arange(len(priorities)), priorities)
+    assert tree.total == priorities.sum()
+
+    values = rng.random(10000) * tree.total
+    expected = np.searchsorted(np.cumsum(priorities), values)
+    np.testing.assert_array_equal(tree.find(values), expected)
+
+
+def test_updates_change_the_sampling_frequencies():
+    sampler = PrioritizedBatchSampler(
+        np.arange(100, 110), batch_size=10, alpha=1.0, epsilon=0.0, seed=0
+    )
+    losses = np.array([1, 1, 1, 1, 1, 2, 2, 4, 8, 19], dtype=np.float64)
+    sampler.update(np.arange(100, 110), losses)
+
+    counts = np.zeros(10)
+    for _ in range(2000):
+        indices, _ = sampler.sample()
+        counts += np.bincount(indices.numpy() - 100, minlength=10)
+    np.testing.assert_allclose(counts / counts.sum(), losses / losses.sum(), rtol=0.1)
+
+
+def test_weights_are_normalized_to_one():
+    sampler = PrioritizedBatchSampler(
+        np.arange(50), batch_size=16, alpha=1.0, beta=0.4, epsilon=0.0, seed=0
+    )
+    priorities = np.random.default_rng(0).gamma(1.0, 1.0, 50) + 0.1
+    sampler.update(np.arange(50), priorities)
+
+    for _ in range(20):
+        indices, weights = sampler.sample()
+        weights = weights.numpy()
+        assert weights.max() == 1.0
+        # (N * P(i)) ** -beta over its maximum is (p_i / p_min) ** -beta
+        p = priorities[indices.numpy()]
+        np.testing.assert_allclose(weights, (p / p.min()) ** -0.4, rtol=1e-5)
@@ -0,0 +1,45 @@
+import multiprocessing
+import os
+import uuid
+
+import numpy as np
+
+from amex.data_loaders.amex.shared_memory import SharedTensorDataset, SharedTensors
+
+
+def read_in_child(dataset, queue):
+    # the dataset pickles as its key, the child attaches to the same segment
+    (x,) = dataset[:]
+    registry = dataset.shared._read_registry()
+    queue.put((x.numpy().copy(), os.getpid() in registry["pids"]))
+    dataset.shared.release()
+
+
+def test_attach_from_a_child_and_release():
+    key = uuid.uuid4().hex
+    x = np.arange(1000, dtype=np.float32).reshape(100, 10)
+    shared = SharedTensors(key, {"x": x})
+    segment = os.path.join("/dev/shm", shared.name)
+    try:
+        assert os.path.exists(segment)
+        dataset = SharedTensorDataset(shared, ["x"])
+
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        child = context.Process(target=read_in_child, args=(dataset, queue))
+        child.start()
+        x_child, registered = queue.get(timeout=60)
+        child.join(timeout=60)
+        assert child.exitcode == 0
+        np.testing.assert_array_equal(x_child, x)
+        assert registered
+
+        # the child released its attachment, the segment lives on for this one
+        assert os.path.exists(segment)
+        assert shared._read_registry()["pids"] == [os.getpid()]
+    finally:
+        shared.release()
+
+    assert not os.path.exists(segment)
+    assert not os.path.exists(shared.registry_file)
+    assert not os.path.exists(shared.lock_file)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from amex.data_loaders.amex.streaming import EpochDataLoader, ShardedDataset
+from amex.data_loaders.amex.tensor_store import (
+    load_shards,
+    save_shards_index,
+    save_tensor_store,
+    shard_path,
+)
+
+
+@pytest.fixture
+def sharded_store(tmp_path):
+    # 5 shards of uneven sizes, y numbers the customers
+    sizes = [40, 13, 27, 50, 8]
+    start = 0
+    for shard, size in enumerate(sizes):
+        x = np.zeros((size, 13, 4), dtype=np.float32)
+        y = np.arange(start, start + size, dtype=np.float32)
+        save_tensor_store(shard_path(tmp_path, shard), x, y)
+        start += size
+    save_shards_index(tmp_path, sizes)
+    return load_shards(tmp_path)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_length_is_exact(sharded_store, shuffle, num_workers):
+    indices = np.random.default_rng(0).choice(138, 100, replace=False)
+    dataset = ShardedDataset(
+        sharded_store, indices, batch_size=7, shuffle=shuffle, shuffle_buffer=16
+    )
+    loader = EpochDataLoader(dataset, batch_size=None, num_workers=num_workers)
+
+    for _ in range(2):
+        batches = list(loader)
+        assert len(batches) == len(loader)
+        # every selected customer once per epoch
+        y = np.concatenate([batch[-1].numpy() for batch in batches])
+        np.testing.assert_array_equal(np.sort(y), np.sort(indices))
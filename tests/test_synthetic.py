@@ -0,0 +1,21 @@
+import pytest
+
+from amex.data_loaders.amex import synthetic
+from amex.data_loaders.amex.profiler import profile_parquet, select_columns
+
+
+@pytest.mark.parametrize("n_customers,seed", [(300, 0), (2000, 1)])
+def test_selection_keeps_the_real_columns(tmp_path, n_customers, seed):
+    path = str(tmp_path / "train_data.parquet")
+    labels = str(tmp_path / "train_labels.csv")
+    synthetic.generate(path, labels, n_customers, seed)
+
+    schema = profile_parquet(path)
+    features, category_codes = select_columns(schema)
+    assert schema["n_customers"] == n_customers
+    assert len(features) == synthetic.n_kept == 157
+    # the models embed 11 categoricals first, ordered by number of classes
+    assert set(category_codes) == set(synthetic.categorical)
+    assert features[:11] == list(category_codes)
+    classes = [len(values) for values in category_codes.values()]
+    assert classes == [2, 2, 2, 2, 3, 3, 4, 6, 7, 7, 7]
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import torch as t
+
+from amex.data_loaders.amex.datasets import RaggedDataset
+from amex.data_loaders.amex.tensor_store import (
+    expand_x,
+    load_header,
+    load_tensor_store,
+    open_array,
+    pad_statements,
+    read_customers,
+    save_tensor_store,
+    x_arrays,
+)
+
+
+def padded_statements(n_customers, n_features, seed=0):
+    # real statements first, then all NaN padding rows, like dense_statements
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=(n_customers, 13, n_features)).astype(np.float32)
+    x[rng.random(x.shape) < 0.3] = np.nan
+    x[..., 0] = 1.0
+    lengths = rng.integers(1, 14, n_customers)
+    x[np.arange(13) >= lengths[:, None]] = np.nan
+    return x, lengths
+
+
+def test_compact_layout_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    x = rng.gamma(1.0, 0.3, (20, 13, 10)).astype(np.float32)
+    x[..., :3] = rng.integers(0, 5, (20, 13, 3))
+    x[rng.random(x.shape) < 0.2] = np.nan
+    save_tensor_store(tmp_path, x, np.zeros(20), layout="compact", n_categorical=3)
+
+    header = load_header(tmp_path)
+    assert header["n_categorical"] == 3
+    arrays = [
+        t.from_numpy(np.array(open_array(tmp_path, name, header)))
+        for name in x_arrays(header)
+    ]
+    expanded = expand_x(header, arrays).numpy()
+    np.testing.assert_allclose(expanded, x, rtol=1e-3, equal_nan=True)
+
+
+def test_compact_layout_rejects_non_integer_categoricals(tmp_path):
+    x = np.full((2, 13, 4), 0.5, dtype=np.float32)
+    with pytest.raises(ValueError):
+        save_tensor_store(tmp_path, x, np.zeros(2), layout="compact", n_categorical=2)
+
+
+def test_ragged_layout_round_trip(tmp_path):
+    x, lengths = padded_statements(50, 6)
+    y = np.arange(50, dtype=np.float32)
+    save_tensor_store(tmp_path, x, y, layout="ragged")
+
+    header = load_header(tmp_path)
+    assert header["arrays"]["statements"]["shape"] == [int(lengths.sum()), 6]
+    statements, offsets, lengths_, y_ = load_tensor_store(
+        tmp_path, x_arrays(header) + ["y"]
+    )
+    np.testing.assert_array_equal(lengths_.numpy(), lengths)
+
+    # customers 10:20 read as a range, and a batch gathered by index
+    batch = read_customers(header, [statements, offsets, lengths_], 10, 20)
+    np.testing.assert_array_equal(expand_x(header, batch).numpy(), x[10:20])
+
+    dataset = RaggedDataset(statements, offsets, lengths_, y_)
+    idx = t.tensor([3, 0, 49, 17])
+    rows, batch_lengths, batch_y = dataset[idx]
+    padded = pad_statements(rows, batch_lengths, header["max_statements"])
+    np.testing.assert_array_equal(padded.numpy(), x[idx.numpy()])
+    np.testing.assert_array_equal(batch_y.numpy(), y[idx.numpy()])